@@ -13,7 +13,6 @@ Humboldt-Universitat zu Berlin
 
 import pyvisa as visa
 import numpy as np
-import matplotlib.pyplot as plt
 import AWGfun
 import pulse_gen as gen
 
@@ -80,7 +79,6 @@ Humboldt-Universitat zu Berlin
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import AWGfun
 
 sample_rate = 2.5E9 #(samples/s)
@@ -145,6 +143,7 @@ name_signal = 'signal_ch_S{}ns'.format(ts_int)
 
 "Plotting pulse sequence"
 def plot_sequence():
+    import matplotlib.pyplot as plt # only loaded when plotting
     plt.close('all')
     fig,axs = plt.subplots(2,1)
     [axs[0].plot(t*1E9,output[i]) for i in range(0,3)]
@@ -191,6 +190,12 @@ using same powermeter PM16-120
 
 import QM_lib_v4 as qm
 import time
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent / "src"))
+from devices import DeviceManager
+from bias_opt import BiasOptimizer, BiasStore
 
 mode = ['min','max']
 run = mode[0] #min to minimize BIAS, max to maximize them
@@ -200,40 +205,78 @@ v2 = 1.6 #Control EOM BIAS
 v_step = 0.005 #voltage steps of the AFG
 long_iter = 50
 
+use_optimizer = True #bracketing + golden-section search instead of the fixed v_step search of afg_bias
+pm_read = None #name of the QM_lib_v4.pm160 method afg_bias reads one power value (in uW) with, required by the optimizer
+n_avg = 5 #power meter reads averaged per bias
+bias_store = BiasStore(Path(__file__).parent / 'scans' / 'eom_bias.json') #last optima, starting points of the next run
+
 factor_pr_pt = 264.46 #conversion from reflected to transmitted power of control beam at PBS
 
+def optimize_bias(ch, v_start, read_power, step):
+    #starts at the last stored optimum of this channel and mode, v_start the first time
+    #read_power() returns one power meter reading in uW
+    set_bias = afg.set_ch1 if ch == 1 else afg.set_ch2
+    optimizer = BiasOptimizer(set_bias, read_power, mode = run, n_avg = n_avg)
+    v, p, cycles = optimizer.optimize(bias_store.get(ch, run, v_start), step = step, tol = v_step)
+    bias_store.put(ch, run, v)
+    print('CH{} bias {} at {:.4f} V: {:.3f} uW after {} set/read cycles'.format(ch, run, v, p, cycles))
+    return v, p
+
+def report_connect(name, latency, error):
+    if error is None:
+        print('{} connected in {:.1f} s'.format(name, latency))
+    else:
+        print('{} failed after {:.1f} s: {}'.format(name, latency, error))
+
+if use_optimizer and pm_read is None:
+    sys.exit('Set pm_read to the PM160 read method of QM_lib_v4 or use_optimizer = False')
+
 try: 
-    #Initializing AFG3102 for BIAS control and setting it to DC mode
-    afg = qm.AFG(afg_ip = 'TCPIP::141.20.46.169::INSTR')
+    #Connecting AFG3102 (BIAS control), elliptec shutters and both PM16-120 at the same time
+    print('Connecting to AFG3102, Elliptec shutters and PM16-120...')
+    devices = DeviceManager({
+        'afg': lambda: qm.AFG(afg_ip = 'TCPIP::141.20.46.169::INSTR'),
+        'shutters': lambda: qm.shutters(com_s = 'COM4',com_c = 'COM13'),
+        'pms': lambda: qm.pm160(address = 'USB0::4883::32891::230105519::0::INSTR'), #signal monitor
+        'pmc': lambda: qm.pm160(address = 'USB0::4883::32891::230105520::0::INSTR'), #control monitor
+    }, on_progress = report_connect)
+    connected = devices.connect()
+    afg = connected.get('afg') #None if the device did not connect (checked in finally)
+    shutters = connected.get('shutters')
+    pms = connected.get('pms')
+    pmc = connected.get('pmc')
+    if devices.errors:
+        raise RuntimeError('Could not connect to ' + ', '.join(devices.errors))
+    if use_optimizer:
+        read_pms, read_pmc = getattr(pms, pm_read), getattr(pmc, pm_read) #fails before any bias is changed
+
+    #Setting AFG to DC mode
     afg.set_ch1(v1)
     afg.set_ch2(v2)
     
-    #Initializing and assigning variables to elliptec shutters 
-    print('Connecting to Elliptec shutters...')
-    shutters = qm.shutters(com_s = 'COM4',com_c = 'COM13')
+    #Assigning variables to elliptec shutters 
     shsignal = shutters.shs()
     shcontrol = shutters.shc()
     
-    #Initializing PM16-120
-    print('Connecting to PM16-120...')
-    pms = qm.pm160(address = 'USB0::4883::32891::230105519::0::INSTR')
-    print('Signal monitor connected')
-    pmc = qm.pm160(address = 'USB0::4883::32891::230105520::0::INSTR')
-    print('Control monitor connected')
-    
     if run == 'min':
         #Minimizer of signal BIAS
         afg_min = qm.afg_bias(afg,pms,pmc) #call for afg, ph and pm objects
         shsignal.open()
         shcontrol.close()
         time.sleep(2)
-        afg_min1 = afg_min.bias_min(ch = 1, v1 = v1, v_step=v_step, max_iter = long_iter)
+        if use_optimizer:
+            afg_min1 = optimize_bias(1, v1, read_pms, step = v_step*10)
+        else:
+            afg_min1 = afg_min.bias_min(ch = 1, v1 = v1, v_step=v_step, max_iter = long_iter)
         
         #Minimizer of control BIAS
         shsignal.close()
         shcontrol.open()
         time.sleep(2)
-        afg_min2 = afg_min.bias_min(ch = 2, v2 = v2, v_step=v_step, max_iter = long_iter)
+        if use_optimizer:
+            afg_min2 = optimize_bias(2, v2, read_pmc, step = v_step*10)
+        else:
+            afg_min2 = afg_min.bias_min(ch = 2, v2 = v2, v_step=v_step, max_iter = long_iter)
         
         shsignal.open()
         shcontrol.open()
@@ -244,13 +287,19 @@ try:
         shsignal.open()
         shcontrol.close()
         time.sleep(2)
-        afg_max1 = afg_max.bias_max(ch = 1, v1 = v1, v_step=v_step*2, max_iter = long_iter)
+        if use_optimizer:
+            afg_max1 = optimize_bias(1, v1, read_pms, step = v_step*20)
+        else:
+            afg_max1 = afg_max.bias_max(ch = 1, v1 = v1, v_step=v_step*2, max_iter = long_iter)
         
         #Maximizer of control BIAS
         shsignal.close()
         shcontrol.open()
         time.sleep(2)
-        afg_max2 = afg_max.bias_max(ch = 2, v2 = v2, v_step=v_step*2, max_iter = long_iter)
+        if use_optimizer:
+            afg_max2 = optimize_bias(2, v2, read_pmc, step = v_step*20)
+        else:
+            afg_max2 = afg_max.bias_max(ch = 2, v2 = v2, v_step=v_step*2, max_iter = long_iter)
         
         shsignal.close()
         shcontrol.open()
@@ -269,13 +318,13 @@ finally: #execute even if exception is not caught
 #%%
     print("\nClosing connection to devices...")
     #Ending connections    
-    if 'shutters' in locals():
+    if 'shutters' in locals() and shutters is not None:
         shutters.disconnect() #closing connection to elliptec shutters
-    if 'afg' in locals():
+    if 'afg' in locals() and afg is not None:
         afg.close_device() #Closing connection to AFG3102 
-    if 'pms' in locals():
+    if 'pms' in locals() and pms is not None:
         pms.close() #Closing connection to signal PM160  
-    if 'pmc' in locals():
+    if 'pmc' in locals() and pmc is not None:
         pmc.close() #Closing connection to control PM160  
  
 
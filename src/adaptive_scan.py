@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class AdaptiveGrid:
+    """
+    Coarse-to-fine scan of the write_width x offset plane for one signal width.
+
+    The coarse grid is measured first. Afterwards the cells whose corners change the
+    most or come closest to the highest counts are split into four, until the point
+    budget is used up or all interesting cells are at the target resolution.
+    """
+
+    def __init__(self, write_width, offset, budget, resolution=None, cells_per_round=4):
+        self.write_width = np.unique(write_width)
+        self.offset = np.unique(offset)
+        self.budget = budget
+        if resolution is None:
+            # three halvings of the coarse spacing
+            resolution = (np.ptp(self.write_width) / max(len(self.write_width) - 1, 1) / 8,
+                          np.ptp(self.offset) / max(len(self.offset) - 1, 1) / 8)
+        self.resolution = resolution
+        self.cells_per_round = cells_per_round
+
+        self.counts = {} # (write_width, offset) -> counts of measured points
+        self.cells = [(w0, w1, o0, o1)
+                      for w0, w1 in zip(self.write_width[:-1], self.write_width[1:])
+                      for o0, o1 in zip(self.offset[:-1], self.offset[1:])]
+
+    def initial_points(self):
+        points = [(w, o) for w in self.write_width for o in self.offset]
+        return points[:self.budget]
+
+    def add(self, write_width, offset, counts):
+        self.counts[(write_width, offset)] = counts
+
+    def score(self, cell, top):
+        "Spread of the corner counts (fast change) plus their maximum (peak), relative to the highest counts"
+        w0, w1, o0, o1 = cell
+        corners = [self.counts.get(point, 0) for point in [(w0, o0), (w0, o1), (w1, o0), (w1, o1)]]
+        return (max(corners) - min(corners) + max(corners)) / top
+
+    def next_points(self):
+        "Points of the next refinement round, empty when the scan is done"
+        remaining = self.budget - len(self.counts)
+        # relative tolerance, halving the coarse spacing does not give the resolution exactly in floats
+        dw, do = self.resolution[0] * (1 + 1E-9), self.resolution[1] * (1 + 1E-9)
+        refinable = [cell for cell in self.cells if cell[1] - cell[0] > dw or cell[3] - cell[2] > do]
+        if remaining <= 0 or not refinable:
+            return []
+
+        top = max(max(self.counts.values(), default=0), 1)
+        refinable.sort(key=lambda cell: self.score(cell, top), reverse=True)
+
+        points = []
+        for cell in refinable[:self.cells_per_round]:
+            w0, w1, o0, o1 = cell
+            wm, om = (w0 + w1) / 2, (o0 + o1) / 2
+            new = [point for point in [(wm, o0), (wm, o1), (w0, om), (w1, om), (wm, om)]
+                   if point not in self.counts and point not in points]
+            if len(points) + len(new) > remaining:
+                break
+            points += new
+            self.cells.remove(cell)
+            self.cells += [(w0, wm, o0, om), (w0, wm, om, o1), (wm, w1, o0, om), (wm, w1, om, o1)]
+
+        return points
@@ -11,17 +11,60 @@ Institut fur Physik
 Humboldt-Universitat zu Berlin
 """
 
-import pyvisa as visa
 import numpy as np
+import time
+import threading
+import hashlib
+from pathlib import Path
+
+from timing import StageTimer
 
 class AwgCtl:
-    def __init__(self):
-        # Set up VISA instrument object
-        rm = visa.ResourceManager('@py')
-        self.awg = rm.open_resource('TCPIP0::141.20.45.148::inst0::INSTR')
+    max_sequence_steps = 16383 # sequencer limit of the AWG5204
+    # timing of the generated waveforms, used by the generators, the histogram windows and the simulation
+    sample_rate = 2.5E9 #(samples/s)
+    samples = 5000 #(maximum 2E9 samples in memory)
+    sample_period = 1E12 / sample_rate # (in ps)
+    repetition_rate = sample_rate / samples # (in Hz) marker rate
+    marker_start = 50 # first sample of marker 1, which triggers the MultiHarp sync
+    marker_stop = samples // 2
+    t0_pulse_p = 150E-9 #(in s) center of pump pulse, start of the pump of the reference
+    tw_pulse_p = 100E-9 #(in s) width of pump pulse
+    t0_pulse_c = t0_pulse_p + tw_pulse_p + 150E-9 #(in s) center of control pulse
+    signal_delay = 27E-9 #(in s) signal after the control pulse at offset 0
+    t_storage = 100E-9 #(in s) Storage time. Delay between write and read pulses
+    pump_pulse = (round(t0_pulse_p * sample_rate), round(tw_pulse_p * 1E9, 6)) # centre (in samples) and width (in ns)
+    chunk_samples = 2**24 # samples per IEEE block, the block length field has at most 9 digits
+    wlist_log = Path("scans/awg_wlist.log") # content hashes of the waveforms on the AWG, kept across sessions
+
+    def __init__(self, resource=None, wlist_log=None):
+        "resource replaces the VISA session (e.g. simulated.SimulatedAwg), wlist_log the default log"
+        if resource is None:
+            # Set up VISA instrument object, pyvisa is only imported once the real AWG is used
+            import pyvisa as visa
+            rm = visa.ResourceManager('@py')
+            resource = rm.open_resource('TCPIP0::141.20.45.148::inst0::INSTR')
+        self.awg = resource
+        self.wlist_log = AwgCtl.wlist_log if wlist_log is None else Path(wlist_log)
         self.awg.timeout = 10000 #float('+inf') #(in ms)
         print('Connected to ', self.awg.query('*idn?'))
 
+        self.output_on = False
+        self.sequence_step = 0
+        # the VISA session is shared with the upload thread of the pipelined scan
+        self.lock = threading.RLock()
+
+        # content hash of every waveform in the waveform list and the waveform loaded on each channel
+        self.wlist = {}
+        self.channel_wfm = {}
+        self.bytes_sent = 0 # waveform and marker data
+        self.last_upload = None
+        self.uploads = StageTimer() # kB and seconds of every waveform + marker upload
+        # every VISA message, for the timing statistics of the scan
+        self.commands = 0
+        self.bytes_written = 0
+        self.sync_wlist()
+
     def __del__(self):
         self.awg.write('output1 off')
         self.awg.write('output2 off')
@@ -30,6 +73,21 @@ class AwgCtl:
         self.awg.write('awgcontrol:stop:immediate')
         self.awg.close()
 
+    def write(self, command):
+        self.commands += 1
+        self.bytes_written += len(command) + 1
+        self.awg.write(command)
+
+    def write_raw(self, message):
+        self.commands += 1
+        self.bytes_written += len(message)
+        self.awg.write_raw(message)
+
+    def query(self, command):
+        self.commands += 1
+        self.bytes_written += len(command) + 1
+        return self.awg.query(command)
+
     def gaussian(x,x0,w):
         w = w/(2*np.sqrt(2*np.log(2)))
         return np.exp(-(x-x0)**2/(2*w**2))
@@ -41,69 +99,118 @@ class AwgCtl:
     def lor(x,x0,w):
         return np.exp((w/2)**2/((x-x0)**2+(w/2)**2))
     
+    def gaussians(x, x0, w):
+        "float32 gaussian for a batch of pulses, x0 and w are column vectors with one row per pulse"
+        k = np.float32(4*np.log(2)) / np.square(w, dtype=np.float32) # 1/(2 sigma^2) from the FWHM
+        out = np.empty(np.broadcast_shapes(np.shape(x), np.shape(x0), np.shape(w)), dtype=np.float32)
+        np.subtract(x, x0, out=out, dtype=np.float32)
+        np.square(out, out=out)
+        out *= -k
+        return np.exp(out, out=out)
+
+    def supergausses(x, x0, w, n):
+        "float32 super-gaussian for a batch of pulses, see gaussians"
+        k = np.float32(4*np.log(2)) / np.square(w, dtype=np.float32)
+        out = np.empty(np.broadcast_shapes(np.shape(x), np.shape(x0), np.shape(w)), dtype=np.float32)
+        np.subtract(x, x0, out=out, dtype=np.float32)
+        np.square(out, out=out)
+        out *= k
+        with np.errstate(over='ignore'): # far tails overflow to inf, exp(-inf) = 0 is what we want
+            np.power(out, n, out=out)
+        np.negative(out, out=out)
+        return np.exp(out, out=out)
+
+    def pulse_window(center, width, delay=0):
+        "Histogram window (start, stop in ps after the sync) of +-width (FWHM in ns) around a pulse centre in samples"
+        t0 = (center - AwgCtl.marker_start) * AwgCtl.sample_period + delay
+        return t0 - width*1E3, t0 + width*1E3
+
     def createMarkerData(marker1_arr):
         # Marker data is an 8 bit value. Bit 7 = marker 1, bit 6 = marker 2, bit 5 = marker 3, bit 4 = marker 4
-        markerData = (1 << 7) * marker1_arr.astype(np.uint8)
+        markerData = np.asarray(marker1_arr, dtype=np.uint8) << 7 # no intermediate copy for uint8 input
         return markerData
 
+    def marker():
+        "Marker 1 of every waveform, it triggers the MultiHarp sync"
+        marker1 = np.zeros(AwgCtl.samples, dtype=np.uint8)
+        marker1[AwgCtl.marker_start:AwgCtl.marker_stop] = 1
+        return marker1
+
+    def scan_pulse_centres(offset):
+        "Centres (in samples) of the write control, read control (retrieved) and signal pulse, independent of the widths"
+        s0_pulse_c = np.rint(AwgCtl.t0_pulse_c*AwgCtl.sample_rate)
+        s0_pulse_r = s0_pulse_c + np.rint(AwgCtl.t_storage*AwgCtl.sample_rate)
+        s0_pulse_s = np.rint((AwgCtl.t0_pulse_c + AwgCtl.signal_delay + np.asarray(offset)*1E-9)*AwgCtl.sample_rate)
+        return s0_pulse_c, s0_pulse_r, s0_pulse_s
+
+    def ref_pulse_time(signal_width):
+        "Centre (in s) of the reference pulse, in the middle of its pump of 5 signal widths"
+        tw_pulse_p = 5 * (np.asarray(signal_width) * 1E-9)
+        return AwgCtl.t0_pulse_p + (tw_pulse_p/2)
+
     def gen_scan_pulse(write_width, signal_width, offset):
-        sample_rate = 2.5E9 #(samples/s)
-        samples = 5000 #(maximum 2E9 samples in memory)
+        "One scan point: row 0 of gen_scan_pulses"
+        samples, control_ch, signal_ch, marker1, s0_pulse_r, s0_pulse_s = AwgCtl.gen_scan_pulses([write_width], [signal_width], [offset])
+        return samples, control_ch[0], signal_ch[0], marker1, s0_pulse_r[0], s0_pulse_s[0]
 
-        tw_pulse_c = write_width * 1E-9 #(in s) width of control pulse
-        tw_pulse_s = signal_width * 1E-9 #(in s) width of signal pulse
-        tw_pulse_p = 100E-9 #(in s) width of pump pulse
+    def gen_scan_pulses(write_width, signal_width, offset):
+        "Takes one value per scan point and returns (N_points x samples) float32 waveforms"
+        sample_rate = AwgCtl.sample_rate
+        samples = AwgCtl.samples
 
-        t0_pulse_p = 150E-9 #(in s) center of pump pulse
-        t0_pulse_c = t0_pulse_p + tw_pulse_p + 150E-9 #(in s) center of control pulse
-        t0_pulse_s = t0_pulse_c + 27E-9 + offset*1E-9 #(in s) center of signal pulse
+        write_width = np.asarray(write_width, dtype=np.float64).ravel()
+        signal_width = np.asarray(signal_width, dtype=np.float64).ravel()
+        offset = np.asarray(offset, dtype=np.float64).ravel()
 
-        t_storage = 100E-9 #(in s) Storage time. Delay between write and read pulses
+        "Control only depends on the write width, signal on signal width and offset: evaluate each distinct pulse once"
+        ww_unique, ww_index = np.unique(write_width, return_inverse=True)
+        so_unique, so_index = np.unique(np.column_stack([signal_width, offset]), axis=0, return_inverse=True)
 
-        mark_start = 50
-        mark_stop = int(samples - samples/2)
+        "Parameters as column vectors, so the pulses broadcast against the sample axis"
+        tw_pulse_c = ww_unique[:, None] * 1E-9 #(in s) width of control pulse
+        tw_pulse_s = so_unique[:, :1] * 1E-9 #(in s) width of signal pulse
 
-        x = np.arange(0,samples)
-        t = x/sample_rate
+        x = np.arange(0, samples, dtype=np.float32)
 
         "Translating time based parameters to samples"
-        s0_pulse_c = np.rint(t0_pulse_c*sample_rate)
-        s0_pulse_s = np.rint(t0_pulse_s*sample_rate)
-        s0_pulse_p = np.rint(t0_pulse_p*sample_rate)
-        s0_pulse_r = s0_pulse_c+s_storage
-        s_storage = np.rint(t_storage*sample_rate)
+        s0_pulse_c, s0_pulse_r, s0_pulse_s = AwgCtl.scan_pulse_centres(so_unique[:, 1:])
+        s0_pulse_p = np.rint(AwgCtl.t0_pulse_p*sample_rate)
         sw_pulse_c = np.rint(tw_pulse_c*sample_rate)
         sw_pulse_s = np.rint(tw_pulse_s*sample_rate)
-        sw_pulse_p = np.rint(tw_pulse_p*sample_rate)
+        sw_pulse_p = np.rint(AwgCtl.tw_pulse_p*sample_rate)
 
-        "Writing pulses"
-        pulse_c = AwgCtl.gaussian(x, s0_pulse_c, sw_pulse_c)+AwgCtl.gaussian(x, s0_pulse_r, sw_pulse_c)
-        pulse_s = AwgCtl.gaussian(x, s0_pulse_s, sw_pulse_s)
-        pulse_p = AwgCtl.supergauss(x, s0_pulse_p, sw_pulse_p, 5)
+        "Writing pulses, the pump is the same for every point"
+        pulse_p = AwgCtl.supergausses(x, s0_pulse_p, sw_pulse_p, 5)
+        control_ch = AwgCtl.gaussians(x, s0_pulse_c, sw_pulse_c)
+        control_ch += AwgCtl.gaussians(x, s0_pulse_r, sw_pulse_c)
+        control_ch += pulse_p
+        signal_ch = AwgCtl.gaussians(x, s0_pulse_s, sw_pulse_s)
 
         "Writting waveforms for maximum amplitude (-1 to 1)"
-        control_ch = 2*(pulse_p+pulse_c)-1 
-        signal_ch = 2*(pulse_s)-1
+        control_ch *= 2
+        control_ch -= 1
+        signal_ch *= 2
+        signal_ch -= 1
 
-        "Storing waveforms"
-        marker1 = np.zeros(samples, dtype=int)
-        marker1[mark_start:mark_stop] = np.ones(mark_stop-mark_start, dtype=int)
+        "Expand to one row per scan point"
+        control_ch = control_ch.take(ww_index, axis=0)
+        signal_ch = signal_ch.take(so_index, axis=0)
+        s0_pulse_r = np.full(len(write_width), s0_pulse_r)
+        s0_pulse_s = s0_pulse_s.ravel().take(so_index)
 
-        return samples, control_ch, signal_ch, marker1, s0_pulse_r, s0_pulse_s
-    
-    def gen_ref_pulse(signal_width):
-        sample_rate = 2.5E9 #(samples/s)
-        samples = 5000 #(maximum 2E9 samples in memory)
+        return samples, control_ch, signal_ch, AwgCtl.marker(), s0_pulse_r, s0_pulse_s
+
+    def gen_ref_pulses(signal_width):
+        "One row of float32 waveforms per signal width"
+        sample_rate = AwgCtl.sample_rate
+        samples = AwgCtl.samples
 
+        signal_width = np.asarray(signal_width, dtype=np.float64).reshape(-1, 1)
         tw_pulse_s = signal_width * 1E-9 #(in s) width of signal pulse
         tw_pulse_p = 5 * tw_pulse_s #(in s) width of pump pulse
-        t0 = 150e-9 + (tw_pulse_p/2) # center of pulse
+        t0 = AwgCtl.ref_pulse_time(signal_width) # center of pulse
 
-        mark_start = 50
-        mark_stop = int(samples - samples/2)
-
-        x = np.arange(0,samples)
-        t = x/sample_rate
+        x = np.arange(0, samples, dtype=np.float32)
 
         "Translating time based parameters to samples"
         s0 = np.rint(t0*sample_rate)
@@ -111,66 +218,238 @@ class AwgCtl:
         sw_pulse_p = np.rint(tw_pulse_p*sample_rate)
 
         "Writing pulses"
-        pulse_s = AwgCtl.gaussian(x, s0, sw_pulse_s)
-        pulse_p = AwgCtl.supergauss(x, s0, sw_pulse_p, 5)
+        signal_ch = AwgCtl.gaussians(x, s0, sw_pulse_s)
+        control_ch = AwgCtl.supergausses(x, s0, sw_pulse_p, 5)
 
         "Writting waveforms for maximum amplitude (-1 to 1)"
-        control_ch = 2*(pulse_p)-1
-        signal_ch = 2*(pulse_s)-1
+        control_ch *= 2
+        control_ch -= 1
+        signal_ch *= 2
+        signal_ch -= 1
 
-        "Storing waveforms"
-        marker1 = np.zeros(samples, dtype=int)
-        marker1[mark_start:mark_stop] = np.ones(mark_stop-mark_start, dtype=int)
+        return samples, control_ch, signal_ch, AwgCtl.marker(), t0.ravel(), tw_pulse_s.ravel()
 
-        return samples, control_ch, signal_ch, marker1, t0, tw_pulse_s
+    def gen_ref_pulse(signal_width):
+        "One reference: row 0 of gen_ref_pulses"
+        samples, control_ch, signal_ch, marker1, t0, tw_pulse_s = AwgCtl.gen_ref_pulses([signal_width])
+        return samples, control_ch[0], signal_ch[0], marker1, t0[0], tw_pulse_s[0]
+
+    def scan_wfm_names(write_width, signal_width, offset):
+        "Deterministic waveform names: control only depends on the write width, signal on signal width and offset"
+        control_name = f"qm_control_w{write_width:.3f}"
+        signal_name = f"qm_signal_s{signal_width:.3f}_o{offset:.3f}"
+        return control_name, signal_name
+
+    def sequence_table(params):
+        "One sequence step per reference and scan point, in the order the scan visits them"
+        steps = []
+        for signal_width in params["signal_width"]:
+            steps.append(AwgCtl.ref_wfm_names(signal_width))
+            for write_width in params["write_width"]:
+                for offset in params["offset"]:
+                    steps.append(AwgCtl.scan_wfm_names(write_width, signal_width, offset))
+        return steps
+
+    def ref_wfm_names(signal_width):
+        control_name = f"ref_control_s{signal_width:.3f}"
+        signal_name = f"ref_signal_s{signal_width:.3f}"
+        return control_name, signal_name
+
+    def sendBlock(self, command, name, data, dtype):
+        """
+        Send data as definite length IEEE blocks from a contiguous buffer.
+        Long records are split into chunks of chunk_samples with increasing start index.
+        Returns bytes, time and throughput of the upload.
+        """
+        data = np.ascontiguousarray(data, dtype=dtype) # no copy if the array already has this layout
+        start = time.perf_counter()
+        for first in range(0, len(data), AwgCtl.chunk_samples):
+            block = memoryview(data[first:first + AwgCtl.chunk_samples]).cast("B")
+            size = len(block) // data.itemsize
+            header = f'{command} "{name}", {first}, {size}, #{len(str(len(block)))}{len(block)}'.encode()
+            # one message per block: one copy of the chunk, some 20 kB for a scan waveform, keeps END on the terminator
+            self.write_raw(b"".join([header, block, b"\n"]))
+        seconds = time.perf_counter() - start
+
+        self.bytes_sent += data.nbytes
+        self.last_upload = {"name": name, "bytes": data.nbytes, "seconds": seconds, "throughput": data.nbytes / max(seconds, 1E-9)}
+        return self.last_upload
 
     def sendMarkerData(self, name, recordLength, markerData):
-        marker_bytes = len(markerData) * 4 #Convert to number of bytes as specified by manual
-        marker_header = 'wlist:waveform:marker:data "{:s}", 0, {:d}, '.format(name, recordLength, len(str(marker_bytes)), marker_bytes) #Marker header (see manual)
-        ret=self.awg.write_binary_values(marker_header, markerData,datatype='B') #Send marker data as binary values
-        return ret
-    
+        "Marker data: one uint8 per sample"
+        return self.sendBlock("wlist:waveform:marker:data", name, markerData[:recordLength], "<u1")
+
     def sendWaveform(self, name, recordLength, wfmArr):
         delete_wfm = 'wlist:waveform:delete "{:s}"'.format(name) #Command to delete waveform with same name from the waveform list
         create_wfm = 'wlist:waveform:new "{:s}", {:d}'.format(name, recordLength) #Command to create waveform with this name
-        wfm_bytes = len(wfmArr) * 4 #Convert to number of bytes as specified by manual
-        wfm_header = 'wlist:waveform:data "{:s}", 0, {:d}, '.format(name, recordLength, len(str(wfm_bytes)), wfm_bytes) #Wfm header (see manual)
-        self.awg.write(delete_wfm)
-        self.awg.write(create_wfm)
-        ret=self.awg.write_binary_values(wfm_header, wfmArr) #Send waveform as binary values
-        return ret
-    
+        self.write(delete_wfm)
+        self.write(create_wfm)
+        return self.sendBlock("wlist:waveform:data", name, wfmArr[:recordLength], "<f4") #Send waveform as float32 binary block
+
     def loadWaveform(self, name, channelNum):
+        "Assign a waveform to a channel, returns False if it is already playing there"
         if channelNum in [1,2]:
-            return self.awg.write(f"source{channelNum}:waveform \"{name}\"")
+            if self.channel_wfm.get(channelNum) == name:
+                return False
+            self.write(f"source{channelNum}:waveform \"{name}\"")
+            self.channel_wfm[channelNum] = name
+            return True
         else:
             print("Enter valid channel number (1 or 2)")
+            return False
+
+    def content_hash(wfmArr, markerData):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(wfmArr, dtype=np.float32).tobytes())
+        h.update(np.ascontiguousarray(markerData, dtype=np.uint8).tobytes())
+        return h.hexdigest()
+
+    def uploadWaveform(self, name, recordLength, wfmArr, markerData):
+        "Send waveform and marker, skipped if the waveform list already holds this content under this name"
+        digest = AwgCtl.content_hash(wfmArr, markerData)
+        with self.lock:
+            if self.wlist.get(name) == digest:
+                return False
+            # invalidate first, so an interrupted upload is never taken for the old content
+            self.log_wlist(name, None)
+            waveform = self.sendWaveform(name, recordLength, wfmArr)
+            marker = self.sendMarkerData(name, recordLength, markerData)
+            sent, seconds = waveform["bytes"] + marker["bytes"], waveform["seconds"] + marker["seconds"]
+            self.last_upload = {"name": name, "bytes": sent, "seconds": seconds, "throughput": sent / max(seconds, 1E-9)}
+            self.uploads.add("kB", sent / 1E3)
+            self.uploads.add("seconds", seconds)
+            self.log_wlist(name, digest)
+            # deleting the waveform removed it from its channel
+            self.channel_wfm = {ch: wfm for ch, wfm in self.channel_wfm.items() if wfm != name}
+            return True
+
+    def log_wlist(self, name, digest):
+        "Record the content of a waveform list entry, None marks it as unknown"
+        if digest is None:
+            self.wlist.pop(name, None)
+        else:
+            self.wlist[name] = digest
+        with open(self.wlist_log, "a") as f:
+            f.write(f"{name}\t{digest or '-'}\n")
+
+    def sync_wlist(self):
+        "Rebuild the waveform list view from the log of earlier sessions and the names the AWG actually holds"
+        logged = {}
+        if self.wlist_log.exists():
+            for line in self.wlist_log.read_text().splitlines():
+                name, _, digest = line.rpartition("\t")
+                logged[name] = digest
+        names = [name.strip().strip('"') for name in self.query('wlist:list?').split(',')]
+        self.wlist = {name: logged[name] for name in names if logged.get(name, "-") != "-"}
+
+        "Compact the log to the current state"
+        self.wlist_log.parent.mkdir(parents=True, exist_ok=True)
+        self.wlist_log.write_text("".join(f"{name}\t{digest}\n" for name, digest in self.wlist.items()))
 
     "Check for error reports from AW"
     def checkErrors(self):
-        error = self.awg.query('system:error:all?')
+        error = self.query('system:error:all?')
         print('Status: {}'.format(error))
 
     def set_awg(self, samples, control_ch, signal_ch, marker1):
-        "Send Waveform Data"
-        self.sendWaveform("control_pulse", samples, control_ch)
-        self.sendWaveform("signal_pulse", samples, signal_ch)
-
-        "Send Marker data"
+        "Send waveform and marker data, unchanged content is not sent again"
         markerData = AwgCtl.createMarkerData(marker1)
-        self.sendMarkerData("control_pulse", samples, markerData)
-        self.sendMarkerData("signal_pulse", samples, markerData)
+        self.uploadWaveform("control_pulse", samples, control_ch, markerData)
+        self.uploadWaveform("signal_pulse", samples, signal_ch, markerData)
 
         "Load waveform onto channels, turn on outputs, and begin playback"
-        self.loadWaveform("control_pulse", 1)
-        self.loadWaveform("signal_pulse", 2)
+        self.switch_awg("control_pulse", "signal_pulse")
+
+        "Check for errors"
+        self.checkErrors()
 
+    def wait_ready(self, timeout=5):
+        "Block until all commands are processed and the AWG is playing, returns False on timeout"
+        with self.lock:
+            self.query('*opc?')
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            with self.lock:
+                rstate = int(self.query('awgcontrol:rstate?')) # 0: stopped, 1: waiting for trigger, 2: running
+            if rstate == 2:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def start_output(self):
         #IMPORTANT: If not sending anything to a channel, need to write the corresponding output off.
-        self.awg.write('output1 on')
-        self.awg.write('output2 on')
-        self.awg.write('output3 off')
-        self.awg.write('output4 off')
-        self.awg.write('awgcontrol:run:immediate') #Start run
+        self.write('output1 on')
+        self.write('output2 on')
+        self.write('output3 off')
+        self.write('output4 off')
+        self.write('awgcontrol:run:immediate') #Start run
+        self.output_on = True
+
+    def point_grid(params, signal_width):
+        "Flat write_width, signal_width, offset arrays of all scan points with this signal width, in scan order"
+        write_width, offset = [a.ravel() for a in np.meshgrid(params["write_width"], params["offset"], indexing="ij")]
+        return write_width, np.full(len(write_width), signal_width), offset
+
+    def preload_scan(self, params):
+        "Upload every waveform of the scan grid (and the references) once before the scan starts"
+        samples, control_ch, signal_ch, marker1, _, _ = AwgCtl.gen_ref_pulses(params["signal_width"])
+        markerData = AwgCtl.createMarkerData(marker1)
+        for row, signal_width in enumerate(params["signal_width"]):
+            control_name, signal_name = AwgCtl.ref_wfm_names(signal_width)
+            self.uploadWaveform(control_name, samples, control_ch[row], markerData)
+            self.uploadWaveform(signal_name, samples, signal_ch[row], markerData)
+
+        for signal_width in params["signal_width"]:
+            points = AwgCtl.point_grid(params, signal_width)
+            samples, control_ch, signal_ch, marker1, _, _ = AwgCtl.gen_scan_pulses(*points)
+            for row, point in enumerate(zip(*points)):
+                control_name, signal_name = AwgCtl.scan_wfm_names(*point)
+                self.uploadWaveform(control_name, samples, control_ch[row], markerData)
+                self.uploadWaveform(signal_name, samples, signal_ch[row], markerData)
+
+        "Check for errors"
+        self.checkErrors()
+
+    def switch_awg(self, control_name, signal_name):
+        "Play preloaded waveforms, only the channel assignment is sent over VISA"
+        with self.lock:
+            changed = self.loadWaveform(control_name, 1)
+            changed = self.loadWaveform(signal_name, 2) or changed
+            if not self.output_on:
+                self.start_output()
+            elif changed:
+                self.write('awgcontrol:run:immediate')
+
+    def build_sequence(self, steps, name="qm_scan"):
+        "Write the sequence table, every step repeats until the next trigger or a forced jump"
+        if len(steps) > AwgCtl.max_sequence_steps:
+            raise ValueError(f"Scan needs {len(steps)} sequence steps, the AWG supports {AwgCtl.max_sequence_steps}")
+
+        self.write('awgcontrol:stop:immediate')
+        self.write('slist:sequence:delete all')
+        self.write(f'slist:sequence:new "{name}", {len(steps)}, 2')
+        for step, (control_name, signal_name) in enumerate(steps, start=1):
+            self.write(f'slist:sequence:step{step}:tasset1:waveform "{name}", "{control_name}"')
+            self.write(f'slist:sequence:step{step}:tasset2:waveform "{name}", "{signal_name}"')
+            self.write(f'slist:sequence:step{step}:rcount "{name}", infinite')
+            self.write(f'slist:sequence:step{step}:ejinput "{name}", atrigger')
+            self.write(f'slist:sequence:step{step}:ejump "{name}", next')
+
+        "Assign the tracks to the channels and start at the first step"
+        self.write(f'source1:casset:sequence "{name}", 1')
+        self.write(f'source2:casset:sequence "{name}", 2')
+        self.channel_wfm = {}
+        self.start_output()
+        self.sequence_step = 1
 
         "Check for errors"
         self.checkErrors()
+
+    def goto_step(self, step):
+        "Advance the sequencer: a trigger for the next step, a forced jump otherwise"
+        if step == self.sequence_step + 1:
+            self.write('trigger:immediate atrigger')
+        elif step != self.sequence_step:
+            self.write(f'source1:jump:force {step}')
+            self.write(f'source2:jump:force {step}')
+        self.sequence_step = step
@@ -0,0 +1,112 @@
+"""
+Scan throughput benchmark on the simulated instruments.
+
+Runs ScanEngine.do_repeated_scan over representative grids and AWG modes and reports
+points per second, the time per point of every stage and the memory per point.
+Instrument times (command latency, uploads, settling, integration) are scaled by
+--time-scale, at 1 they match the hardware, below 1 the software overhead dominates.
+
+    python src/benchmark.py --grid 5x5x2 10x10x2 --awg-mode upload preload sequence pipelined
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+import simulated
+from scan_engine import ScanEngine
+
+# stages of ScanEngine.timer in report order, one-off stages are spread over the points
+stages = ["preload", "sequence", "generate", "program", "settle", "acquire", "counts", "publish"]
+
+
+def grid_params(shape):
+    "write_width x offset x signal_width points over the ranges the GUI uses"
+    n_write, n_offset, n_signal = shape
+    return {
+        "write_width": np.linspace(5, 40, n_write),
+        "offset": np.linspace(-10, 10, n_offset),
+        "signal_width": np.linspace(5, 20, n_signal),
+    }
+
+
+def run(shape, awg_mode, acq_mode="histogram", acq_time=1000, time_scale=0.01, seed=0):
+    "One scan on fresh simulated instruments, returns the report row"
+    worker = ScanEngine(simulated.factories(time_scale, seed=seed), "references")
+    worker.connect_devices()
+
+    params = grid_params(shape)
+    params.update({"awg_mode": awg_mode, "settle_mode": "awg", "acq_mode": acq_mode, "acq_time": acq_time,
+                   "ref_ttl": 0, "store_path": "scan.qms"})
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    worker.do_repeated_scan(params)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    points = worker.n_points
+    stats = worker.scan_stats()
+    totals = {stage: stats["stages"].get(stage, {"total": 0.0})["total"] for stage in stages}
+    return {
+        "grid": "x".join(map(str, shape)),
+        "awg_mode": awg_mode,
+        "points": points,
+        "points/s": points / seconds,
+        "ms/point": {stage: total / points * 1E3 for stage, total in totals.items()},
+        "other ms/point": (seconds - sum(totals.values())) / points * 1E3,
+        "commands/point": stats["visa_total"]["commands"] / points,
+        "kB sent/point": stats["visa_total"]["bytes"] / points / 1E3,
+        "peak kB/point": peak / points / 1E3,
+        "file kB/point": Path("scan.qms").stat().st_size / points / 1E3,
+    }
+
+
+def report(rows):
+    header = ["grid", "awg mode", "points", "points/s", *stages, "other", "cmd/pt", "kB sent/pt", "peak kB/pt", "file kB/pt"]
+    print(" ".join(f"{name:>10}" for name in header))
+    print(" ".join(f"{'':>10}" for _ in header[:4]) + " " + " ".join(f"{'(ms/pt)':>10}" for _ in [*stages, "other"]))
+    for row in rows:
+        values = [row["grid"], row["awg_mode"], row["points"], f"{row['points/s']:.2f}"]
+        values += [f"{row['ms/point'][stage]:.2f}" for stage in stages] + [f"{row['other ms/point']:.2f}"]
+        values += [f"{row['commands/point']:.1f}", f"{row['kB sent/point']:.1f}", f"{row['peak kB/point']:.1f}", f"{row['file kB/point']:.1f}"]
+        print(" ".join(f"{value:>10}" for value in values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", nargs="+", default=["3x3x1", "10x10x2"], help="write_width x offset x signal_width points")
+    parser.add_argument("--awg-mode", nargs="+", default=["upload", "preload", "sequence", "pipelined"])
+    parser.add_argument("--acq-mode", default="histogram", choices=["histogram", "stream"])
+    parser.add_argument("--acq-time", type=int, default=1000, help="integration time per point in ms")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="factor on all instrument times")
+    args = parser.parse_args()
+
+    # the reference cache key hashes the MultiHarp settings, the channel roles set the data shape
+    configs = [Path(name).resolve() for name in ["MH.ini", "MH_channels.ini"] if Path(name).exists()]
+    rows = []
+    cwd = os.getcwd()
+    for grid in args.grid:
+        shape = tuple(int(n) for n in grid.split("x"))
+        for awg_mode in args.awg_mode:
+            # scan files and the waveform list log go to a scratch directory
+            with tempfile.TemporaryDirectory() as scratch:
+                for config in configs:
+                    shutil.copyfile(config, Path(scratch) / config.name)
+                os.chdir(scratch)
+                try:
+                    rows.append(run(shape, awg_mode, args.acq_mode, args.acq_time, args.time_scale))
+                finally:
+                    os.chdir(cwd)
+    report(rows)
+
+
+if __name__ == "__main__":
+    main()
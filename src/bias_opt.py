@@ -0,0 +1,115 @@
+"""
+EOM bias optimisation with few AFG set / power meter read cycles.
+
+The transmitted power of an EOM is a smooth (sinusoidal) function of its bias.
+Starting from the last stored optimum, a minimum (or maximum) is bracketed by
+expanding steps and then narrowed down by golden-section search, with a parabolic
+fit through the best three points as the final estimate. Every power value is the
+average of several meter reads, and no bias is set twice.
+"""
+
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+golden = (np.sqrt(5) - 1) / 2
+
+
+class BiasOptimizer:
+    """
+    set_bias(v) sets the bias voltage, read_power() returns one power meter reading.
+    mode is "min" or "max", bounds (in V) the allowed bias range.
+    """
+
+    def __init__(self, set_bias, read_power, mode="min", n_avg=5, settle=0.1, bounds=(-5, 5)):
+        self.set_bias = set_bias
+        self.read_power = read_power
+        self.sign = 1 if mode == "min" else -1
+        self.n_avg = n_avg
+        self.settle = settle # (in s) after setting the bias, before reading
+        self.bounds = bounds
+        self.evaluations = {} # bias -> mean power
+
+    def power(self, v):
+        "Mean power at bias v, each bias is only set and read once"
+        v = float(np.clip(round(v, 6), *self.bounds))
+        if v not in self.evaluations:
+            self.set_bias(v)
+            time.sleep(self.settle)
+            self.evaluations[v] = float(np.mean([self.read_power() for _ in range(self.n_avg)]))
+        return self.evaluations[v]
+
+    def cost(self, v):
+        return self.sign * self.power(v)
+
+    def bracket(self, v0, step, max_steps=20):
+        "Three biases a, b, c (b between a and c) with cost(b) below both ends"
+        a, b = v0, v0 + step
+        if self.cost(b) > self.cost(a):
+            a, b = b, a # go downhill
+        c = b + (b - a) / golden
+        for _ in range(max_steps):
+            if self.cost(c) >= self.cost(b) or not self.bounds[0] < c < self.bounds[1]:
+                break
+            a, b, c = b, c, c + (c - b) / golden
+        c = float(np.clip(c, *self.bounds))
+        return (a, b, c) if a < c else (c, b, a)
+
+    def golden_section(self, a, b, c, tol):
+        "Shrink the bracket until it is narrower than tol, returns the best bias found"
+        while c - a > tol:
+            # probe the larger of the two intervals
+            if c - b > b - a:
+                x = b + (1 - golden) * (c - b)
+                if self.cost(x) < self.cost(b):
+                    a, b = b, x
+                else:
+                    c = x
+            else:
+                x = b - (1 - golden) * (b - a)
+                if self.cost(x) < self.cost(b):
+                    c, b = b, x
+                else:
+                    a = x
+        return a, b, c
+
+    def parabola(self, a, b, c):
+        "Vertex of the parabola through the three points, b if they are (nearly) collinear"
+        fa, fb, fc = self.cost(a), self.cost(b), self.cost(c)
+        denom = (b - a) * (fb - fc) - (b - c) * (fb - fa)
+        if abs(denom) < 1E-12:
+            return b
+        v = b - 0.5 * ((b - a)**2 * (fb - fc) - (b - c)**2 * (fb - fa)) / denom
+        return v if a < v < c else b
+
+    def optimize(self, v0, step=0.05, tol=0.005):
+        """
+        Bias of the minimum (maximum) power near v0 to within tol (in V).
+        Returns bias, power and the number of set / read cycles.
+        """
+        self.evaluations = {}
+        a, b, c = self.bracket(v0, step)
+        a, b, c = self.golden_section(a, b, c, tol)
+        v = self.parabola(a, b, c)
+        if self.cost(v) > self.cost(b):
+            v = b
+        self.set_bias(v)
+        return v, self.power(v), len(self.evaluations)
+
+
+class BiasStore:
+    "Last optimum of every channel and mode, the warm start of the next calibration"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.optima = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    def get(self, channel, mode, default):
+        return self.optima.get(f"{mode}{channel}", default)
+
+    def put(self, channel, mode, bias):
+        self.optima[f"{mode}{channel}"] = bias
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(self.optima, indent=1))
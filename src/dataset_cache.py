@@ -0,0 +1,80 @@
+from collections import OrderedDict
+
+from scan_store import ScanStore
+
+
+class DatasetCache:
+    """
+    Datasets of the GUI by name, with the histograms bounded by a memory budget (in bytes).
+
+    Every dataset is backed by a row of a scan file. Histograms that were used recently
+    are kept in RAM, the least recently used ones are dropped and read back from the scan
+    file when they are needed again. Results that are still in the worker's result buffer
+    are read from there instead.
+    """
+
+    def __init__(self, budget, on_evict=None):
+        self.budget = budget
+        self.on_evict = on_evict
+        self.results = {} # name -> result without histogram
+        self.cached = OrderedDict() # name -> histogram, least recently used first
+        self.nbytes = 0
+        self.stores = {}
+
+    def __contains__(self, name):
+        return name in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def add(self, name, result, store_path, row):
+        "The histogram is not copied, it is loaded on first access"
+        self.discard(name)
+        result = {key: value for key, value in result.items() if key != "data"}
+        result["store_path"] = str(store_path)
+        result["row"] = row
+        self.results[name] = result
+
+    def __getitem__(self, name):
+        result = self.results[name]
+        if name in self.cached:
+            self.cached.move_to_end(name)
+        else:
+            self.cached[name] = self.load(result)
+            self.nbytes += self.cached[name].nbytes
+            self.evict(keep=name)
+        return dict(result, data=self.cached[name])
+
+    def load(self, result):
+        if "buffer" in result:
+            row = result["buffer"].row(result["index"])
+            if row is not None:
+                return row.copy()
+
+        path = result["store_path"]
+        if path not in self.stores:
+            self.stores[path] = ScanStore.open(path)
+        store = self.stores[path]
+        result.setdefault("bins", store.bins)
+        return store.rows["data"][result["row"]].copy()
+
+    def evict(self, keep=None):
+        "Drop least recently used histograms until the budget is met"
+        while self.nbytes > self.budget and len(self.cached) > 1:
+            name = next(iter(self.cached))
+            if name == keep:
+                break
+            self.nbytes -= self.cached.pop(name).nbytes
+            if self.on_evict is not None:
+                self.on_evict(name)
+
+    def discard(self, name):
+        self.results.pop(name, None)
+        if name in self.cached:
+            self.nbytes -= self.cached.pop(name).nbytes
+
+    def clear(self):
+        self.results.clear()
+        self.cached.clear()
+        self.nbytes = 0
+        self.stores.clear()
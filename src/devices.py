@@ -0,0 +1,40 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class DeviceManager:
+    """
+    Connects instruments concurrently, so startup takes as long as the slowest device.
+    factories maps a device name to a function that connects and returns the device,
+    on_progress(name, latency in s, error or None) is called as each device finishes.
+    """
+
+    def __init__(self, factories, on_progress=None):
+        self.factories = factories
+        self.on_progress = on_progress
+        self.devices = {}
+        self.latency = {}
+        self.errors = {}
+
+    def connect_one(self, name):
+        start = time.perf_counter()
+        try:
+            return self.factories[name](), None, time.perf_counter() - start
+        except Exception as e:
+            return None, e, time.perf_counter() - start
+
+    def connect(self):
+        "Connect all devices, returns the connected ones by name, failures are in errors"
+        with ThreadPoolExecutor(max_workers=len(self.factories)) as pool:
+            futures = {pool.submit(self.connect_one, name): name for name in self.factories}
+            for future in as_completed(futures):
+                name = futures[future]
+                device, error, latency = future.result()
+                self.latency[name] = latency
+                if error is None:
+                    self.devices[name] = device
+                else:
+                    self.errors[name] = error
+                if self.on_progress is not None:
+                    self.on_progress(name, latency, error)
+        return self.devices
@@ -1,32 +1,51 @@
 import sys
-from PySide6 import QtCore, QtWidgets, QtGui, QtGraphs, QtGraphsWidgets, QtCharts
+from PySide6 import QtCore, QtWidgets, QtGui
 from PySide6.QtCore import QThread, Signal
 import pyqtgraph as pg
 
-import pickle
+import shutil
+import time
 from pathlib import Path
 import numpy as np
 
 from scanner import ScanWorker
+from scan_store import ScanStore
+from plot_manager import PlotManager
+from parameter_map import ParameterMap
+from dataset_cache import DatasetCache
+from timing import StageTimer, format_stats, upload_rate, write_stats
 
 pg.setConfigOption('background', 'w')
 pg.setConfigOption('foreground', 'k')
 
 class MyWidget(QtWidgets.QWidget):
     start_scanning = Signal(dict)
-    scan_data = {}
+    connect_devices = Signal()
+    store_path = None
+    result_buffer = None
 
-    def __init__(self):
+    def __init__(self, simulate=False):
         super().__init__()
 
         # thread for scanning in background
         self.worker_thread = QThread()
-        self.scan_worker = ScanWorker()
+        if simulate:
+            # simulated instruments, references are kept apart from the real ones
+            import simulated
+            self.scan_worker = ScanWorker(simulated.factories(), "scans/simulated/references")
+        else:
+            self.scan_worker = ScanWorker()
         self.scan_worker.moveToThread(self.worker_thread)
         self.worker_thread.finished.connect(self.scan_worker.deleteLater)
         self.scan_worker.finished_qm_scan.connect(self.update_qm_scan_data)
         self.scan_worker.finished_ref_scan.connect(self.update_ref_scan_data)
+        self.scan_worker.partial_data.connect(self.update_partial_data)
+        self.scan_worker.new_result_buffer.connect(self.set_result_buffer)
         self.start_scanning.connect(self.scan_worker.do_repeated_scan)
+        self.scan_worker.device_connected.connect(self.update_device_status)
+        self.scan_worker.devices_ready.connect(self.set_devices_ready)
+        self.scan_worker.timing_stats.connect(self.update_timing)
+        self.connect_devices.connect(self.scan_worker.connect_devices)
         self.worker_thread.start()
 
         # item model that references the data from each measurement
@@ -45,6 +64,14 @@ class MyWidget(QtWidgets.QWidget):
         self.signal_plot: pg.PlotItem = graph.addPlot()
         self.signal_plot.setLabels(title="", bottom="Time [x]", left="Counts")
         self.signal_plot.showGrid(x=True, y=True)
+        # histogram of the running acquisition in stream mode
+        self.live_curve = pg.PlotDataItem(pen=pg.mkPen(0.5, width=1))
+        self.signal_plot.addItem(self.live_curve)
+        self.plot_manager = PlotManager(self.signal_plot)
+        # write_width x offset map of the running scan below the histograms
+        self.parameter_map = ParameterMap(graph.addPlot(row=1, col=0))
+        # histograms in RAM are bounded, evicted ones are reloaded from the scan files
+        self.scan_data = DatasetCache(256 * 2**20, on_evict=self.plot_manager.remove_hidden)
 
         # properties on the right:
         # splitted vertically: up: measurement series list; bottom: scan settings
@@ -85,6 +112,17 @@ class MyWidget(QtWidgets.QWidget):
         data_del_button.setIcon(QtGui.QIcon.fromTheme(QtGui.QIcon.ThemeIcon.EditDelete))
         data_del_button.clicked.connect(self.delete_data)
 
+        # memory budget of the dataset cache
+        cache_layout = QtWidgets.QHBoxLayout()
+        data_control_box_layout.addLayout(cache_layout)
+        cache_layout.addWidget(QtWidgets.QLabel("cache"))
+        cache_budget_box = QtWidgets.QSpinBox()
+        cache_budget_box.setRange(16, 65536)
+        cache_budget_box.setSuffix(" MB")
+        cache_budget_box.setValue(256)
+        cache_budget_box.valueChanged.connect(self.set_cache_budget)
+        cache_layout.addWidget(cache_budget_box)
+
         # list of data
         data_list = QtWidgets.QListView()
         data_control_box_layout.addWidget(data_list)
@@ -94,9 +132,13 @@ class MyWidget(QtWidgets.QWidget):
         # end measurement series list
         ###
 
+        # scan settings with the timing statistics of the scan next to them
+        settings_layout = QtWidgets.QHBoxLayout()
+        properties_layout.addLayout(settings_layout)
+
         # QGroupBox as container for scan settings
         scan_control_box = QtWidgets.QGroupBox("Scan setting")
-        properties_layout.addWidget(scan_control_box)
+        settings_layout.addWidget(scan_control_box)
         scan_control_box_layout = QtWidgets.QVBoxLayout()
         scan_control_box.setLayout(scan_control_box_layout)
 
@@ -106,9 +148,106 @@ class MyWidget(QtWidgets.QWidget):
             self.parameter_widgets[parameter_name] = ref
             scan_control_box_layout.addLayout(item)
 
-        scan_control_start_button = QtWidgets.QPushButton("start")
-        scan_control_box_layout.addWidget(scan_control_start_button)
-        scan_control_start_button.clicked.connect(self.start_scan)
+        strategy_layout = QtWidgets.QHBoxLayout()
+        scan_control_box_layout.addLayout(strategy_layout)
+        strategy_layout.addWidget(QtWidgets.QLabel("strategy"))
+        self.strategy_box = QtWidgets.QComboBox()
+        self.strategy_box.addItems(["grid", "adaptive"])
+        self.strategy_box.setToolTip("adaptive uses the ranges as coarse grid and refines it around features")
+        strategy_layout.addWidget(self.strategy_box)
+        self.point_budget_box = QtWidgets.QSpinBox()
+        self.point_budget_box.setRange(1, 100000)
+        self.point_budget_box.setValue(200)
+        self.point_budget_box.setToolTip("points per signal width in adaptive mode")
+        strategy_layout.addWidget(self.point_budget_box)
+
+        map_layout = QtWidgets.QHBoxLayout()
+        scan_control_box_layout.addLayout(map_layout)
+        map_layout.addWidget(QtWidgets.QLabel("map signal width"))
+        self.map_box = QtWidgets.QComboBox()
+        self.map_box.setToolTip("counts relative to the reference of this signal width")
+        self.map_box.currentIndexChanged.connect(self.show_map)
+        map_layout.addWidget(self.map_box)
+
+        awg_mode_layout = QtWidgets.QHBoxLayout()
+        scan_control_box_layout.addLayout(awg_mode_layout)
+        awg_mode_layout.addWidget(QtWidgets.QLabel("awg mode"))
+        self.awg_mode_box = QtWidgets.QComboBox()
+        self.awg_mode_box.addItems(["upload", "preload", "sequence", "pipelined"])
+        awg_mode_layout.addWidget(self.awg_mode_box)
+
+        settle_layout = QtWidgets.QHBoxLayout()
+        scan_control_box_layout.addLayout(settle_layout)
+        settle_layout.addWidget(QtWidgets.QLabel("settle"))
+        self.settle_mode_box = QtWidgets.QComboBox()
+        self.settle_mode_box.addItems(["awg", "awg + mh", "fixed"])
+        settle_layout.addWidget(self.settle_mode_box)
+        self.min_dwell_box = QtWidgets.QDoubleSpinBox()
+        self.min_dwell_box.setSuffix(" s")
+        self.min_dwell_box.setValue(0.1)
+        settle_layout.addWidget(self.min_dwell_box)
+
+        acq_mode_layout = QtWidgets.QHBoxLayout()
+        scan_control_box_layout.addLayout(acq_mode_layout)
+        acq_mode_layout.addWidget(QtWidgets.QLabel("acquisition"))
+        self.acq_mode_box = QtWidgets.QComboBox()
+        self.acq_mode_box.addItems(["histogram", "stream", "adaptive"])
+        acq_mode_layout.addWidget(self.acq_mode_box)
+        self.acq_time_box = QtWidgets.QSpinBox()
+        self.acq_time_box.setRange(10, 600000)
+        self.acq_time_box.setSuffix(" ms")
+        self.acq_time_box.setValue(1000)
+        self.acq_time_box.setToolTip("integration time, maximum in adaptive mode")
+        acq_mode_layout.addWidget(self.acq_time_box)
+        self.target_box = QtWidgets.QDoubleSpinBox()
+        self.target_box.setRange(0.001, 1)
+        self.target_box.setDecimals(3)
+        self.target_box.setSingleStep(0.01)
+        self.target_box.setValue(0.05)
+        self.target_box.setToolTip("target relative uncertainty of the pulse windows in adaptive mode")
+        acq_mode_layout.addWidget(self.target_box)
+        self.roi_box = QtWidgets.QCheckBox("ROI")
+        self.roi_box.setToolTip("only keep the histogram around the pulses")
+        acq_mode_layout.addWidget(self.roi_box)
+
+        ref_layout = QtWidgets.QHBoxLayout()
+        scan_control_box_layout.addLayout(ref_layout)
+        ref_layout.addWidget(QtWidgets.QLabel("reuse references"))
+        self.ref_ttl_box = QtWidgets.QSpinBox()
+        self.ref_ttl_box.setRange(0, 24*60)
+        self.ref_ttl_box.setSuffix(" min")
+        self.ref_ttl_box.setValue(30)
+        self.ref_ttl_box.setToolTip("maximum age of a stored reference, 0 always measures")
+        ref_layout.addWidget(self.ref_ttl_box)
+
+        self.scan_control_start_button = QtWidgets.QPushButton("start")
+        scan_control_box_layout.addWidget(self.scan_control_start_button)
+        self.scan_control_start_button.clicked.connect(self.start_scan)
+        self.scan_control_resume_button = QtWidgets.QPushButton("resume")
+        self.scan_control_resume_button.setToolTip("continue an interrupted scan file from its first unfinished point")
+        scan_control_box_layout.addWidget(self.scan_control_resume_button)
+        self.scan_control_resume_button.clicked.connect(self.resume_scan)
+
+        # instruments connect in the background once the window is up
+        self.scan_control_start_button.setEnabled(False)
+        self.scan_control_resume_button.setEnabled(False)
+        self.device_status = QtWidgets.QLabel("connecting instruments...")
+        scan_control_box_layout.addWidget(self.device_status)
+        self.device_messages = []
+
+        # QGroupBox as container for the timing statistics
+        timing_box = QtWidgets.QGroupBox("Timing")
+        settings_layout.addWidget(timing_box)
+        timing_box_layout = QtWidgets.QVBoxLayout()
+        timing_box.setLayout(timing_box_layout)
+        self.timing_label = QtWidgets.QLabel("no scan yet")
+        self.timing_label.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.SystemFont.FixedFont))
+        self.timing_label.setAlignment(QtCore.Qt.AlignmentFlag.AlignTop)
+        timing_box_layout.addWidget(self.timing_label)
+        # time the GUI spends on adding finished points
+        self.display_timer = StageTimer()
+
+        self.connect_devices.emit()
 
     def closeEvent(self, event):
         self.stop_scanning()
@@ -155,56 +294,168 @@ class MyWidget(QtWidgets.QWidget):
         return layout, (val_min, val_max, val_step)
 
     def start_scan(self):
+        self.display_timer.clear()
         self.model.clear()
-        self.scan_data = {}
+        self.scan_data.clear()
         self.plot_data()
 
         parameters = {name: np.linspace(ref[0].value(), ref[1].value(), ref[2].value()) for name, ref in self.parameter_widgets.items()}
-        
+        parameters["scan_strategy"] = self.strategy_box.currentText()
+        parameters["point_budget"] = self.point_budget_box.value()
+        parameters["awg_mode"] = self.awg_mode_box.currentText()
+        parameters["settle_mode"] = self.settle_mode_box.currentText()
+        parameters["min_dwell"] = self.min_dwell_box.value()
+        parameters["acq_mode"] = self.acq_mode_box.currentText()
+        parameters["acq_time"] = self.acq_time_box.value()
+        parameters["target_uncertainty"] = self.target_box.value()
+        parameters["roi"] = self.roi_box.isChecked()
+        parameters["ref_ttl"] = self.ref_ttl_box.value() * 60
+        self.store_path = Path("scans") / f"scan_{time.strftime('%Y%m%d_%H%M%S')}.qms"
+        parameters["store_path"] = str(self.store_path)
+
+        self.setup_map(parameters)
         self.start_scanning.emit(parameters)
 
-    def update_qm_scan_data(self, result):
-        name = f"{round(result["write_width"],2)} {round(result["signal_width"],2)} {round(result["offset"],2)}"
-        self.scan_data[name] = result
-        item = self.new_item(name)
-        self.model.appendRow(item)
+    def setup_map(self, parameters):
+        self.parameter_map.setup(parameters)
+        self.map_box.blockSignals(True)
+        self.map_box.clear()
+        self.map_box.addItems([f"{signal_width:.2f} ns" for signal_width in parameters["signal_width"]])
+        self.map_box.blockSignals(False)
+
+    def show_map(self, index):
+        if index >= 0:
+            self.parameter_map.show(index)
+
+    def resume_scan(self):
+        "Finished points of the scan file are shown again, the worker measures the rest with the stored parameters"
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Resume scan", "scans", "Scan files (*.qms)")
+        if not path:
+            return
+        self.display_timer.clear()
+        self.model.clear()
+        self.scan_data.clear()
+        self.plot_data()
 
-    def update_ref_scan_data(self, result):
-        name = f"Reference: {round(result["signal_width"],2)}"
-        self.scan_data[name] = result
+        self.store_path = Path(path)
+        self.setup_map(ScanStore.open(path).header["params"])
+        self.start_scanning.emit({"resume": True, "store_path": path})
+
+    def update_device_status(self, name, latency, error):
+        if error:
+            self.device_messages.append(f"{name}: failed after {latency:.1f} s ({error})")
+        else:
+            self.device_messages.append(f"{name}: connected in {latency:.1f} s")
+        self.device_status.setText("\n".join(self.device_messages))
+
+    def set_devices_ready(self, ok):
+        self.scan_control_start_button.setEnabled(ok)
+        self.scan_control_resume_button.setEnabled(ok)
+
+    def set_result_buffer(self, result_buffer):
+        self.result_buffer = result_buffer
+
+    def result_view(self, result):
+        "Results from the worker only carry the index of their histogram in the result buffer"
+        if "index" in result:
+            buffer = self.result_buffer
+            result = dict(result, buffer=buffer, bins=buffer.bins, data=buffer.row(result["index"]))
+        return result
+
+    def add_dataset(self, name, result, store_path, row):
+        "Worker results are rows of the current scan file, their point index is the row"
+        if store_path is None:
+            store_path, row = self.store_path, result["index"]
+        self.scan_data.add(name, result, store_path, row)
+        if name in self.plot_manager.curves:
+            self.plot_manager.update(name, self.scan_data[name])
         item = self.new_item(name)
         self.model.appendRow(item)
 
+    def update_qm_scan_data(self, result, prefix="", store_path=None, row=None):
+        with self.display_timer.stage("display"):
+            result = self.result_view(result)
+            name = prefix + f"{round(result["write_width"],2)} {round(result["signal_width"],2)} {round(result["offset"],2)}"
+            self.add_dataset(name, result, store_path, row)
+            if store_path is None:
+                self.parameter_map.add_point(result)
+
+    def update_ref_scan_data(self, result, prefix="", store_path=None, row=None):
+        with self.display_timer.stage("display"):
+            result = self.result_view(result)
+            name = prefix + f"Reference: {round(result["signal_width"],2)}"
+            self.add_dataset(name, result, store_path, row)
+            if store_path is None:
+                self.parameter_map.add_reference(result)
+
+    def update_timing(self, stats):
+        "Show the stage statistics of the worker and the GUI, the final ones are exported next to the scan file"
+        stats = dict(stats, stages=dict(stats["stages"], **self.display_timer.stats()))
+        visa = stats["visa_total"]
+        self.timing_label.setText("\n".join([
+            f"{stats['points']} points",
+            format_stats(stats["stages"]),
+            format_stats(stats["visa"], 1, "per point"),
+            f"VISA: {visa['commands']} commands, {visa['bytes'] / 1E6:.1f} MB",
+            format_stats(stats["uploads"], 1, "per upload"),
+            upload_rate(stats["uploads"]),
+        ]))
+        if stats["final"] and self.store_path is not None:
+            write_stats(self.store_path, stats)
+
+    def set_cache_budget(self, megabytes):
+        self.scan_data.budget = megabytes * 2**20
+        self.scan_data.evict()
+
+    def update_partial_data(self, result):
+        "The live curve shows the first role, the signal"
+        self.live_curve.setData(result["bins"], np.atleast_2d(result["data"])[0])
+
     def stop_scanning(self):
         self.scan_worker._stop = True
 
     def save_current_data(self):
-        pass
+        "The running scan is already on disk, saving copies its file"
+        if self.store_path is None or not self.store_path.exists():
+            return
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save scan", str(self.store_path.name), "Scan files (*.qms)")
+        if path:
+            shutil.copyfile(self.store_path, path)
+            timing = self.store_path.with_suffix(".timing.json")
+            if timing.exists():
+                shutil.copyfile(timing, Path(path).with_suffix(".timing.json"))
 
     def load_data(self):
-        pass
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Load scan", "scans", "Scan files (*.qms)")
+        if not path:
+            return
+        store = ScanStore.open(path)
+        prefix = f"{Path(path).stem}: "
+        for row, result in enumerate(store.results()):
+            if "write_width" in result:
+                self.update_qm_scan_data(result, prefix, path, row)
+            else:
+                self.update_ref_scan_data(result, prefix, path, row)
 
     def delete_data(self):
         pass
 
-    def plot_data(self):
-        self.signal_plot.clear()
-
-        for row in range(self.model.rowCount()):
-            item = self.model.item(row)
-            color = pg.intColor(row)
-   
-            if item.checkState() == QtCore.Qt.CheckState.Checked:
-                pen = pg.mkPen(color, width=2)
-                dataset_name = item.text()
-                result = self.scan_data[dataset_name]
+    def plot_data(self, item=None):
+        "Show or hide the curve of the item that changed, without item all curves are removed"
+        if item is None:
+            self.plot_manager.clear()
+            return
 
-                self.signal_plot.plot(result["bins"][:6000], result["data"][:6000], pen=pen)
+        dataset_name = item.text()
+        if item.checkState() == QtCore.Qt.CheckState.Checked:
+            self.plot_manager.show(dataset_name, self.scan_data[dataset_name], pg.intColor(item.row()))
+        else:
+            self.plot_manager.hide(dataset_name)
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication([])
 
-    widget = MyWidget()
+    widget = MyWidget(simulate="--simulate" in sys.argv)
     widget.resize(800, 600)
     widget.show()
 
@@ -1,21 +1,142 @@
-from snAPI.Main import *
+import configparser
+import time
+import numpy as np
+
+from stream import StreamHistogram, histogram_events
 
 class MhCtl:
-    def __init__(self):
+    roles_path = "./MH_channels.ini" # input channel of every role, see read_roles
+    rate_gate = 0.1 # (in s) count rates are updated every 100 ms
+
+    def __init__(self, snapi=None):
+        "snapi replaces the snAPI.Main module (e.g. simulated.snapi_module)"
+        # snAPI is only imported once a MultiHarp is actually used
+        if snapi is None:
+            from snAPI import Main as snapi
+        self.snapi = snapi
+
         # Init Multiharp
-        self.sn = snAPI()
+        self.sn = self.snapi.snAPI()
         self.sn.getDevice()
 
-        self.sn.initDevice(MeasMode.Histogram)
+        self.mode = self.snapi.MeasMode.Histogram
+        self.sn.initDevice(self.mode)
         self.sn.loadIniConfig("./MH.ini")
 
+        # kept channels, the data of every measurement has one row per role in this order
+        self.roles = MhCtl.read_roles(MhCtl.roles_path)
+        self.channels = list(self.roles.values())
+
+        self.roi = None
+        self.roi_index = None
+        self.roi_bins = None
+        self.roi_nbins = 0
+
     def __del__(self):
         self.sn.closeDevice()
 
-    def get_data(self):
-        self.sn.histogram.measure(acqTime=1000, waitFinished=True, savePTU=True)
+    def read_roles(path):
+        "Role name -> input channel from the [Roles] section, only the signal on channel 1 without the file"
+        config = configparser.ConfigParser()
+        if not config.read(path) or not config.has_section("Roles"):
+            return {"signal": 1}
+        return {role: config.getint("Roles", role) for role in config.options("Roles")}
+
+    def set_mode(self, mode):
+        "Re-initialise the device only if the measurement mode changes"
+        if mode != self.mode:
+            self.sn.initDevice(mode)
+            self.sn.loadIniConfig("./MH.ini")
+            self.mode = mode
+
+    def set_roi(self, windows):
+        "Only keep the bins inside these windows (start, stop in ps), None keeps the full histogram"
+        self.roi = windows
+        self.roi_index = None
+
+    def apply_roi(self, data, bins):
+        "Slice data (one row per role) to the region of interest, the sliced bins are the same array for every point"
+        if self.roi is None:
+            return data, bins
+        if self.roi_index is None or self.roi_nbins != len(bins):
+            self.roi_index = np.concatenate([np.arange(*np.searchsorted(bins, window)) for window in self.roi])
+            self.roi_bins = np.asarray(bins)[self.roi_index]
+            self.roi_nbins = len(bins)
+        return np.asarray(data)[..., self.roi_index], self.roi_bins
+
+    def get_data(self, acq_time=1000):
+        "Histograms of all roles from one measurement, data is roles x bins"
+        self.set_mode(self.snapi.MeasMode.Histogram)
+        self.sn.histogram.measure(acqTime=acq_time, waitFinished=True, savePTU=False)
         data, bins = self.sn.histogram.getData()
 
-        data = data[1]
-        bins = bins
-        return data, bins
+        data = np.stack([data[channel] for channel in self.channels]) # data[0] is the sync
+        return self.apply_roi(data, bins)
+
+    def live_events(self, acq_time, interval=0.1):
+        "Event source from the device in T2 mode, yields (times in ps, channels) every interval seconds"
+        self.sn.unfold.measure(acqTime=acq_time, waitFinished=False, savePTU=False)
+        finished = False
+        try:
+            while True:
+                finished = self.sn.unfold.isFinished()
+                times, channels = self.sn.unfold.getData()
+                if len(times):
+                    yield times, channels
+                if finished:
+                    return
+                time.sleep(interval)
+        finally:
+            # the consumer stopped early
+            if not finished:
+                self.sn.unfold.stopMeasure()
+
+    def get_data_streaming(self, acq_time=1000, on_partial=None):
+        "Like get_data, but binned from time tags as they arrive, on_partial(data, bins) gets the histograms so far"
+        self.set_mode(self.snapi.MeasMode.T2)
+        hist = StreamHistogram(self.sn.deviceConfig["Resolution"], channel=self.channels)
+        return self.apply_roi(*histogram_events(self.live_events(acq_time), hist, on_partial))
+
+    def get_data_adaptive(self, windows, target=0.05, max_time=5000, on_partial=None):
+        """
+        Stream until every window (start, stop in ps) of the first role holds enough counts for a relative
+        Poisson uncertainty of target, or max_time (in ms) has passed.
+        Returns data, bins and the integration time in ms.
+        """
+        self.set_mode(self.snapi.MeasMode.T2)
+        hist = StreamHistogram(self.sn.deviceConfig["Resolution"], channel=self.channels)
+        needed = 1 / target**2
+
+        start = time.perf_counter()
+        events = self.live_events(max_time)
+        for times, channels in events:
+            hist.add(times, channels)
+            if on_partial is not None:
+                on_partial(hist.data, hist.bins)
+            if all(hist.window_counts(*window) >= needed for window in windows):
+                events.close()
+                break
+        acq_time = (time.perf_counter() - start) * 1E3
+
+        return *self.apply_roi(hist.data, hist.bins), min(acq_time, max_time)
+
+    def wait_settled(self, since, timeout=2, tolerance=0.1):
+        """
+        Wait until the count rate of the first role has settled on the pattern played since since (perf_counter):
+        two consecutive readings, both counted completely after since, agree within tolerance plus their
+        Poisson noise. Returns False on timeout.
+        """
+        channel = self.channels[0]
+        # the counters are updated every rate_gate, the first full gate after since ends at most two gates later
+        time.sleep(max(since + 2*self.rate_gate - time.perf_counter(), 0))
+        previous = None
+        while True:
+            rate = self.sn.getCountRates()[1][channel - 1]
+            if previous is not None:
+                noise = 3 * np.sqrt(max(rate, previous, 1) / self.rate_gate)
+                if abs(rate - previous) <= tolerance * max(rate, previous) + noise:
+                    return True
+            if time.perf_counter() - since > timeout:
+                return False
+            previous = rate
+            time.sleep(self.rate_gate)
@@ -0,0 +1,94 @@
+import numpy as np
+import pyqtgraph as pg
+from PySide6 import QtCore
+
+
+class ParameterMap:
+    """
+    write_width x offset image of the counts of every point, one map per signal width,
+    normalised to the reference of that signal width.
+
+    The maps are preallocated from the scan ranges. A finished point writes one pixel,
+    found from its parameters by arithmetic on the grid step, and only marks the map
+    as changed. The shown map is redrawn at most every redraw_interval, so the cost of
+    a point does not grow with the size of the map.
+    """
+    redraw_interval = 100 # (in ms)
+    refine = 8 # adaptive scans go down to 1/8 of the coarse grid spacing, see AdaptiveGrid
+
+    def __init__(self, plot: pg.PlotItem):
+        self.plot = plot
+        self.image = pg.ImageItem()
+        self.image.setColorMap(pg.colormap.get("viridis"))
+        self.plot.addItem(self.image)
+        self.plot.setLabels(bottom="write width [ns]", left="offset [ns]")
+        self.colorbar = pg.ColorBarItem(colorMap=pg.colormap.get("viridis"), interactive=False)
+        self.colorbar.setImageItem(self.image, insert_in=self.plot)
+
+        self.signal_widths = {} # rounded signal width -> map index
+        self.maps = np.zeros((0, 0, 0))
+        self.references = np.zeros(0)
+        self.origin = (0, 0)
+        self.step = (1, 1)
+        self.shown = 0
+
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.redraw_interval)
+        self.timer.timeout.connect(self.redraw)
+
+    def axis(values, divisions=1):
+        "First value, step and length of an evenly spaced axis covering values"
+        values = np.unique(values)
+        if len(values) < 2:
+            return values[0], 1.0, 1
+        step = (values[-1] - values[0]) / (len(values) - 1) / divisions
+        return values[0], step, int(round((values[-1] - values[0]) / step)) + 1
+
+    def setup(self, params):
+        "New, empty maps for the ranges of a scan"
+        divisions = self.refine if params.get("scan_strategy", "grid") == "adaptive" else 1
+        x0, dx, nx = ParameterMap.axis(params["write_width"], divisions)
+        y0, dy, ny = ParameterMap.axis(params["offset"], divisions)
+        self.origin, self.step = (x0, y0), (dx, dy)
+        self.signal_widths = {round(float(sw), 6): k for k, sw in enumerate(params["signal_width"])}
+        self.maps = np.full((len(self.signal_widths), nx, ny), np.nan)
+        self.references = np.full(len(self.signal_widths), np.nan)
+        self.image.setRect(QtCore.QRectF(x0 - dx/2, y0 - dy/2, nx*dx, ny*dy))
+        self.show(0)
+
+    def add_reference(self, result):
+        k = self.signal_widths.get(round(float(result["signal_width"]), 6))
+        if k is not None:
+            self.references[k] = result["counts"]
+            self.changed(k)
+
+    def add_point(self, result):
+        k = self.signal_widths.get(round(float(result["signal_width"]), 6))
+        if k is None:
+            return
+        i = int(round((result["write_width"] - self.origin[0]) / self.step[0]))
+        j = int(round((result["offset"] - self.origin[1]) / self.step[1]))
+        if 0 <= i < self.maps.shape[1] and 0 <= j < self.maps.shape[2]:
+            self.maps[k, i, j] = result["counts"]
+            self.changed(k)
+
+    def changed(self, k):
+        if k == self.shown and not self.timer.isActive():
+            self.timer.start()
+
+    def show(self, k):
+        self.shown = k
+        self.redraw()
+
+    def redraw(self):
+        if not len(self.maps):
+            return
+        reference = self.references[self.shown]
+        image = self.maps[self.shown] / (reference if reference > 0 else 1)
+        finite = image[np.isfinite(image)]
+        levels = (finite.min(), finite.max()) if len(finite) else (0, 1)
+        if levels[0] == levels[1]:
+            levels = (levels[0], levels[0] + 1)
+        self.image.setImage(image, levels=levels, autoLevels=False)
+        self.colorbar.setLevels(levels)
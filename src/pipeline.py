@@ -0,0 +1,109 @@
+import queue
+import threading
+
+from awg_ctl import AwgCtl
+
+
+class ScanPipeline:
+    """
+    Generates and uploads upcoming scan points on an AWG thread while the current point is acquired,
+    and hands measured points to an analysis thread, which runs analyse(*job) for counts, storage
+    and publishing of the previous point while the next one is acquired.
+    """
+    done = object() # end of scan marker in the queues
+
+    def __init__(self, awg_ctl, params, analyse, depth=2):
+        self.awg_ctl = awg_ctl
+        self.params = params
+        self.analyse = analyse
+        # bounded, so the AWG thread only runs depth points ahead of the acquisition
+        self.queue = queue.Queue(maxsize=depth)
+        # and the analysis at most depth points behind it
+        self.results = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self.prepare, daemon=True)
+        self.analysis_thread = threading.Thread(target=self.consume, daemon=True)
+        self.error = None
+        self.analysis_error = None
+
+    def start(self):
+        self.thread.start()
+        self.analysis_thread.start()
+
+    def stop(self):
+        "Stop the uploads, the points measured so far are still analysed"
+        self._stop.set()
+        self.thread.join()
+        self.results.put(ScanPipeline.done)
+        self.analysis_thread.join()
+
+    def put(self, point):
+        "Put into the queue, but give up when the scan is stopped"
+        while not self._stop.is_set():
+            try:
+                self.queue.put(point, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def prepare(self):
+        "AWG thread: upload the waveforms of every point in scan order, then hand the point over"
+        try:
+            samples, ref_control, ref_signal, marker1, _, _ = AwgCtl.gen_ref_pulses(self.params["signal_width"])
+            markerData = AwgCtl.createMarkerData(marker1)
+
+            for ref_row, signal_width in enumerate(self.params["signal_width"]):
+                control_name, signal_name = AwgCtl.ref_wfm_names(signal_width)
+                self.awg_ctl.uploadWaveform(control_name, samples, ref_control[ref_row], markerData)
+                self.awg_ctl.uploadWaveform(signal_name, samples, ref_signal[ref_row], markerData)
+                if not self.put(("ref", signal_width)):
+                    return
+
+                points = AwgCtl.point_grid(self.params, signal_width)
+                samples, control_ch, signal_ch, marker1, _, _ = AwgCtl.gen_scan_pulses(*points)
+                for row, point in enumerate(zip(*points)):
+                    control_name, signal_name = AwgCtl.scan_wfm_names(*point)
+                    self.awg_ctl.uploadWaveform(control_name, samples, control_ch[row], markerData)
+                    self.awg_ctl.uploadWaveform(signal_name, samples, signal_ch[row], markerData)
+                    if not self.put(("scan", *point)):
+                        return
+        except Exception as e:
+            self.error = e
+        self.put(ScanPipeline.done)
+
+    def submit(self, *job):
+        "Queue a measured point for the analysis thread, raises the error of an earlier analysis"
+        if self.analysis_error is not None:
+            raise self.analysis_error
+        self.results.put(job)
+
+    def drain(self):
+        "Wait until every submitted point is analysed"
+        self.results.join()
+        if self.analysis_error is not None:
+            raise self.analysis_error
+
+    def consume(self):
+        "Analysis thread: analyse the measured points in scan order, skipping all after an error"
+        while True:
+            job = self.results.get()
+            try:
+                if job is ScanPipeline.done:
+                    return
+                if self.analysis_error is None:
+                    self.analyse(*job)
+            except Exception as e:
+                self.analysis_error = e
+            finally:
+                self.results.task_done()
+
+    def __iter__(self):
+        "Points that are ready to be switched to, in scan order"
+        while True:
+            point = self.queue.get()
+            if point is ScanPipeline.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield point
@@ -0,0 +1,54 @@
+import numpy as np
+import pyqtgraph as pg
+from PySide6 import QtCore
+
+
+class PlotManager:
+    """
+    Keeps the PlotDataItems of every dataset, which are only shown, hidden or updated instead of replotting everything.
+    Datasets with several channel roles get one curve per role, in the dataset's colour with a different line style.
+    """
+    styles = [QtCore.Qt.PenStyle.SolidLine, QtCore.Qt.PenStyle.DashLine, QtCore.Qt.PenStyle.DotLine, QtCore.Qt.PenStyle.DashDotLine]
+
+    def __init__(self, plot: pg.PlotItem):
+        self.plot = plot
+        self.curves = {} # name -> list of curves, one per role
+
+        # draw full length histograms: only the visible range, reduced to about one point per pixel
+        self.plot.setDownsampling(auto=True, mode="peak")
+        self.plot.setClipToView(True)
+
+    def show(self, name, result, color):
+        curves = self.curves.get(name)
+        if curves is None:
+            curves = []
+            for row, data in enumerate(np.atleast_2d(result["data"])):
+                style = PlotManager.styles[row % len(PlotManager.styles)]
+                curve = pg.PlotDataItem(result["bins"], data, pen=pg.mkPen(color, width=2, style=style))
+                curves.append(curve)
+                self.plot.addItem(curve)
+            self.curves[name] = curves
+        for curve in curves:
+            curve.setVisible(True)
+
+    def hide(self, name):
+        for curve in self.curves.get(name, []):
+            curve.setVisible(False)
+
+    def update(self, name, result):
+        for curve, data in zip(self.curves.get(name, []), np.atleast_2d(result["data"])):
+            curve.setData(result["bins"], data)
+
+    def remove(self, name):
+        for curve in self.curves.pop(name, []):
+            self.plot.removeItem(curve)
+
+    def remove_hidden(self, name):
+        "Drop the curves, and with them their copy of the data, unless they are shown"
+        curves = self.curves.get(name)
+        if curves is not None and not curves[0].isVisible():
+            self.remove(name)
+
+    def clear(self):
+        for name in list(self.curves):
+            self.remove(name)
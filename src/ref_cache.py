@@ -0,0 +1,43 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+class ReferenceCache:
+    "Reference measurements on disk, keyed by signal width, reference waveforms and instrument settings"
+
+    def __init__(self, path, ttl=1800):
+        self.path = Path(path)
+        self.ttl = ttl # (in s) older references are measured again because of drift
+
+    def key(signal_width, control_ch, signal_ch, settings, ini_path="./MH.ini"):
+        "Hash of everything the reference histogram depends on, settings is a json serialisable dict"
+        h = hashlib.sha1()
+        h.update(f"{signal_width:.3f}".encode())
+        h.update(np.ascontiguousarray(control_ch, dtype=np.float32).tobytes())
+        h.update(np.ascontiguousarray(signal_ch, dtype=np.float32).tobytes())
+        h.update(Path(ini_path).read_bytes())
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        "Stored result if it is younger than ttl, otherwise None"
+        file = self.path / f"{key}.npz"
+        if self.ttl <= 0 or not file.exists():
+            return None
+        with np.load(file) as stored:
+            if time.time() - float(stored["time"]) > self.ttl:
+                return None
+            result = json.loads(str(stored["metadata"]))
+            result["bins"] = stored["bins"]
+            result["data"] = stored["data"]
+        return result
+
+    def put(self, key, result):
+        self.path.mkdir(parents=True, exist_ok=True)
+        metadata = {name: value for name, value in result.items() if name not in ["bins", "data"]}
+        np.savez(self.path / f"{key}.npz", time=time.time(), metadata=json.dumps(metadata, default=float),
+                 bins=result["bins"], data=result["data"])
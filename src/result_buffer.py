@@ -0,0 +1,24 @@
+import numpy as np
+
+
+class ResultBuffer:
+    "Preallocated histograms of one scan: the worker writes row by row, the GUI reads views into it"
+
+    def __init__(self, capacity, bins, shape=None, dtype=np.uint32):
+        "shape of the data of one point, by default one histogram over bins"
+        self.bins = np.array(bins)
+        self.data = np.zeros((capacity, *(shape or (len(self.bins),))), dtype=dtype)
+        self.count = 0 # rows written so far, the write position wraps around at capacity
+
+    def write(self, data):
+        "Copy one histogram into the next row and return its point index"
+        index = self.count
+        self.data[index % len(self.data)] = data
+        self.count += 1
+        return index
+
+    def row(self, index):
+        "View of the histogram of a point, None once it has been overwritten"
+        if index < self.count - len(self.data):
+            return None
+        return self.data[index % len(self.data)]
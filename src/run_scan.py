@@ -0,0 +1,126 @@
+"""
+Run scans from definition files without the GUI.
+
+Every definition file (TOML or JSON) is one scan, the files are run one after the
+other with the instruments connected once. Ranges are either a list of values or
+start, stop and points like the spin boxes of the GUI, settings are the scan
+parameters of the GUI.
+
+    output = "scans/overnight_1.qms"  # default scans/<file name>_<date>_<time>.qms
+
+    [ranges]
+    write_width = { start = 5, stop = 40, points = 8 }
+    signal_width = [5, 10]
+    offset = { start = -10, stop = 10, points = 11 }
+
+    [settings]
+    awg_mode = "preload"        # upload, preload, sequence or pipelined
+    settle_mode = "awg"         # awg, awg + mh or fixed
+    acq_mode = "histogram"      # histogram, stream or adaptive
+    acq_time = 1000             # ms
+    ref_ttl = 1800              # s
+
+    python src/run_scan.py scans/queue/*.toml
+"""
+
+import argparse
+import json
+import sys
+import time
+import tomllib
+from pathlib import Path
+
+import numpy as np
+
+from scan_engine import ScanEngine
+
+ranges = ["write_width", "signal_width", "offset"]
+
+
+def load_definition(path):
+    "Scan parameters and output path of a definition file"
+    path = Path(path)
+    with open(path, "rb") as f:
+        definition = json.load(f) if path.suffix == ".json" else tomllib.load(f)
+
+    params = dict(definition.get("settings", {}))
+    for name in ranges:
+        value = definition["ranges"][name]
+        if isinstance(value, dict):
+            value = np.linspace(value["start"], value["stop"], value["points"])
+        params[name] = np.atleast_1d(np.asarray(value, dtype=np.float64))
+    output = definition.get("output") or f"scans/{path.stem}_{time.strftime('%Y%m%d_%H%M%S')}.qms"
+    return params, Path(output)
+
+
+class Progress:
+    "One line per finished point"
+
+    def __init__(self, engine, quiet=False):
+        self.engine = engine
+        self.quiet = quiet
+        self.start = time.perf_counter()
+        engine.finished_ref_scan.connect(self.point)
+        engine.finished_qm_scan.connect(self.point)
+
+    def point(self, result):
+        if self.quiet:
+            return
+        done = result["point"] + 1
+        rate = done / max(time.perf_counter() - self.start, 1E-9)
+        if "write_width" in result:
+            name = f"w {result['write_width']:.3f} s {result['signal_width']:.3f} o {result['offset']:.3f}"
+        else:
+            name = f"reference s {result['signal_width']:.3f}"
+        print(f"{done:>6}/{self.engine.n_points} {name:<32} counts {result['counts']:>10.1f}  {rate:.2f} points/s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("definitions", nargs="+", help="scan definition files, run in this order")
+    parser.add_argument("--resume", action="store_true", help="continue scans whose output file already exists")
+    parser.add_argument("--simulate", action="store_true", help="use the simulated AWG and MultiHarp")
+    parser.add_argument("--quiet", action="store_true", help="no line per point")
+    args = parser.parse_args()
+
+    scans = [(path, *load_definition(path)) for path in args.definitions] # fail on a broken file before connecting
+    if args.simulate:
+        import simulated
+        engine = ScanEngine(simulated.factories(), "scans/simulated/references")
+    else:
+        engine = ScanEngine()
+    engine.device_connected.connect(lambda name, latency, error: print(f"{name}: {error or 'connected'} after {latency:.1f} s"))
+    engine.connect_devices()
+    if engine.awg_ctl is None or engine.mh_ctl is None:
+        return 1
+
+    failed = []
+    for path, params, output in scans:
+        if output.exists() and not args.resume:
+            print(f"{path}: {output} exists, use --resume to continue it")
+            failed.append(path)
+            continue
+        if output.exists():
+            params = {"resume": True}
+        params["store_path"] = str(output)
+
+        print(f"{path} -> {output}")
+        progress = Progress(engine, args.quiet)
+        try:
+            engine.do_repeated_scan(params)
+        except KeyboardInterrupt:
+            print(f"Interrupted, continue with --resume {path}")
+            return 130
+        except Exception as e:
+            print(f"{path} failed: {e!r}")
+            failed.append(path)
+        finally:
+            engine.finished_ref_scan.disconnect(progress.point)
+            engine.finished_qm_scan.disconnect(progress.point)
+        print(f"{path}: {engine.point_index} points in {time.perf_counter() - progress.start:.0f} s")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,466 @@
+"""
+The scan loop without Qt.
+
+ScanEngine programs the AWG, acquires with the MultiHarp, stores and publishes every
+point. Its results are announced through hooks with the emit/connect interface of Qt
+signals, so scanner.ScanWorker can replace them by real signals for the GUI while
+run_scan.py uses the engine directly, without importing Qt.
+"""
+
+import time
+
+from awg_ctl import AwgCtl
+from mh_ctl import MhCtl
+from pipeline import ScanPipeline
+from adaptive_scan import AdaptiveGrid
+from scan_store import ScanStore
+from result_buffer import ResultBuffer
+from ref_cache import ReferenceCache
+from devices import DeviceManager
+from analysis import merge_windows, window_counts
+from timing import StageTimer, write_stats
+import numpy as np
+
+
+class Hook:
+    "Stand-in for a Qt Signal: every instance gets its own list of functions that emit() calls"
+
+    def __set_name__(self, owner, name):
+        self.attribute = f"_hook_{name}"
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        if self.attribute not in obj.__dict__:
+            obj.__dict__[self.attribute] = BoundHook()
+        return obj.__dict__[self.attribute]
+
+
+class BoundHook:
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def disconnect(self, slot):
+        self.slots.remove(slot)
+
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+
+class ScanEngine:
+    finished_qm_scan = Hook() # (dict) scalars and result buffer index of a point
+    finished_ref_scan = Hook() # (dict) the same for a reference
+    partial_data = Hook() # (dict) bins and data of the running acquisition
+    new_result_buffer = Hook() # (ResultBuffer) of a new scan
+    device_connected = Hook() # (str, float, str) name, latency and error of a device
+    devices_ready = Hook() # (bool) all devices connected
+    timing_stats = Hook() # (dict) stage statistics of the running scan
+    fixed_dwell = 2 # (in s) settle time without readiness check and fallback if the check times out
+    acq_time = 1000 # (in ms) integration time per point, upper limit in adaptive mode
+    hist_delay = 0 # (in ps) delay between the AWG marker and the pulses in the histogram
+    background_window = (0, 60000) # (in ps) before the pump pulse, used for background subtraction
+    buffer_rows = 1024 # maximum number of histograms in the result buffer, older points are read from the scan file
+    stats_interval = 0.5 # (in s) between timing_stats updates during a scan
+
+    def __init__(self, factories=None, ref_cache_path="scans/references"):
+        "factories connect the instruments by name (see simulated.factories), by default the real AWG and MultiHarp"
+        self._stop = False
+        self.factories = {"AWG": AwgCtl, "MultiHarp": MhCtl} if factories is None else factories
+        self.awg_mode = "upload"
+        self.settle_mode = "fixed"
+        self.min_dwell = 0
+        self.acq_mode = "histogram"
+        self.scan_strategy = "grid"
+        self.target_uncertainty = 0.05
+        self.sequence_steps = {}
+        self.pulses = None
+        self.pulse_rows = {}
+        self.store_path = None
+        self.store = None
+        self.result_buffer = None
+        self.n_points = 0
+        self.point_index = 0 # position of the next point in scan order, references included
+        self.next_point = 0 # the same on the scan thread, ahead of point_index while a pipeline analyses points
+        self.completed = {} # point index -> row of the scan file that is resumed
+        self.pipeline = None # ScanPipeline of the running pipelined scan, its thread analyses the points
+        self.ref_cache = ReferenceCache(ref_cache_path)
+        # per point durations of the scan stages and VISA traffic
+        self.timer = StageTimer()
+        self.visa = StageTimer()
+        self.awg_start = (0, 0, 0) # AWG commands, bytes and waveform bytes at the start of the scan
+        self.stats_time = 0
+
+        # instruments are connected by connect_devices in the worker thread
+        self.awg_ctl = None
+        self.mh_ctl = None
+
+    def __del__(self):
+        del(self.mh_ctl)
+        del(self.awg_ctl)
+
+    def connect_devices(self):
+        "Connect AWG and MultiHarp concurrently, reporting each device's connect latency"
+        def progress(name, latency, error):
+            self.device_connected.emit(name, latency, "" if error is None else str(error))
+
+        manager = DeviceManager(self.factories, on_progress=progress)
+        devices = manager.connect()
+        self.awg_ctl = devices.get("AWG")
+        self.mh_ctl = devices.get("MultiHarp")
+        self.devices_ready.emit(not manager.errors)
+
+    def get_counts(self, data, bins, windows):
+        "Background subtracted counts of the first role in the last window: the reference or the retrieved pulse"
+        background = np.add(self.background_window, self.hist_delay)
+        return float(window_counts(np.atleast_2d(data)[0], bins, windows, background)[0, -1])
+
+    def program_reference(self, signal_width):
+        if self.awg_mode in ["preload", "pipelined"]:
+            self.awg_ctl.switch_awg(*AwgCtl.ref_wfm_names(signal_width))
+        elif self.awg_mode == "sequence":
+            self.awg_ctl.goto_step(self.sequence_steps[AwgCtl.ref_wfm_names(signal_width)])
+        else:
+            "Generate Pulses"
+            samples, control_ch, signal_ch, marker1, t0, tw_pulse_s = AwgCtl.gen_ref_pulse(signal_width)
+            self.awg_ctl.set_awg(samples, control_ch, signal_ch, marker1)
+
+    def program_point(self, write_width, signal_width, offset):
+        if self.awg_mode in ["preload", "pipelined"]:
+            self.awg_ctl.switch_awg(*AwgCtl.scan_wfm_names(write_width, signal_width, offset))
+        elif self.awg_mode == "sequence":
+            self.awg_ctl.goto_step(self.sequence_steps[AwgCtl.scan_wfm_names(write_width, signal_width, offset)])
+        else:
+            "Pulses were generated for the whole signal width in prepare_pulses"
+            samples, control_ch, signal_ch, marker1, s0_pulse_r, s0_pulse_s = self.pulses
+            row = self.pulse_rows[AwgCtl.scan_wfm_names(write_width, signal_width, offset)]
+            self.awg_ctl.set_awg(samples, control_ch[row], signal_ch[row], marker1)
+
+    def prepare_pulses(self, points):
+        "Generate the waveforms of all points (write_width, signal_width, offset arrays) in one batch"
+        with self.timer.stage("generate"):
+            self.pulses = AwgCtl.gen_scan_pulses(*points)
+        self.pulse_rows = {AwgCtl.scan_wfm_names(*point): row for row, point in enumerate(zip(*points))}
+
+    def settle(self, start):
+        "Wait until the new pulses are played, but at least min_dwell after start"
+        if self.settle_mode == "fixed":
+            time.sleep(self.fixed_dwell)
+            return
+
+        ready = self.awg_ctl.wait_ready()
+        if ready and self.settle_mode == "awg + mh":
+            # the sync (marker 1) is the same for every pattern, the detector rate tells the new one is played
+            ready = self.mh_ctl.wait_settled(time.perf_counter())
+        if not ready:
+            print("Readiness check timed out, falling back to fixed dwell")
+            time.sleep(self.fixed_dwell)
+
+        remaining = self.min_dwell - (time.perf_counter() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def acquire(self, windows):
+        "Returns data, bins and the integration time in ms, windows (in ps) are used by the adaptive mode"
+        if self.acq_mode == "adaptive":
+            return self.mh_ctl.get_data_adaptive(windows, self.target_uncertainty, self.acq_time, on_partial=self.emit_partial)
+        if self.acq_mode == "stream":
+            return *self.mh_ctl.get_data_streaming(self.acq_time, on_partial=self.emit_partial), self.acq_time
+        return *self.mh_ctl.get_data(self.acq_time), self.acq_time
+
+    def ref_windows(self, signal_width):
+        "Histogram window of the reference pulse"
+        t0 = AwgCtl.ref_pulse_time(signal_width)
+        return [AwgCtl.pulse_window(np.rint(t0*AwgCtl.sample_rate), signal_width, self.hist_delay)]
+
+    def point_windows(self, write_width, signal_width, offset):
+        "Histogram windows of the transmitted signal and the retrieved pulse"
+        s0_pulse_c, s0_pulse_r, s0_pulse_s = AwgCtl.scan_pulse_centres(offset)
+        return [AwgCtl.pulse_window(s0_pulse_s, signal_width, self.hist_delay), AwgCtl.pulse_window(s0_pulse_r, signal_width, self.hist_delay)]
+
+    def emit_partial(self, data, bins):
+        "data has one row per role"
+        self.partial_data.emit({"bins": bins, "data": data.copy()})
+
+    def scan_roi(self, params):
+        "Windows around pump, reference, signal and retrieved pulses of every point, plus the background window"
+        windows = [AwgCtl.pulse_window(*AwgCtl.pump_pulse, self.hist_delay), tuple(np.add(self.background_window, self.hist_delay))]
+        for signal_width in params["signal_width"]:
+            windows += self.ref_windows(signal_width)
+            # pulse centres do not depend on the write width and move monotonically with the offset,
+            # so one window from the first to the last offset covers the signal of every point
+            first = self.point_windows(params["write_width"][0], signal_width, np.min(params["offset"]))
+            last = self.point_windows(params["write_width"][0], signal_width, np.max(params["offset"]))
+            windows += first + last
+            windows.append((min(first[0][0], last[0][0]), max(first[0][1], last[0][1])))
+        return merge_windows(windows)
+
+    def publish(self, result, signal, store=True):
+        "Write the histogram into the result buffer, store the point and emit only its index and scalars"
+        with self.timer.stage("publish"):
+            self.publish_result(result, signal, store)
+        if time.perf_counter() - self.stats_time > self.stats_interval:
+            self.emit_stats()
+
+    def publish_result(self, result, signal, store):
+        result["point"] = self.point_index
+        self.point_index += 1
+        if self.result_buffer is None:
+            self.result_buffer = ResultBuffer(min(self.n_points, self.buffer_rows), result["bins"], np.shape(result["data"]))
+            self.new_result_buffer.emit(self.result_buffer)
+        index = self.result_buffer.write(result["data"])
+        result["data"] = self.result_buffer.row(index)
+        if store:
+            self.store_result(result)
+
+        metadata = {name: value for name, value in result.items() if name not in ["bins", "data"]}
+        metadata["index"] = index
+        signal.emit(metadata)
+
+    def store_result(self, result):
+        "Append the point to the scan file, which is created with the bins of the first point"
+        if self.store_path is None:
+            return
+        if self.store is None:
+            self.store = ScanStore.create(self.store_path, result["bins"], self.scan_params, np.shape(result["data"]), self.mh_ctl.roles)
+        self.store.append(result)
+
+    def scan_stats(self, final=False):
+        "Stage statistics and VISA traffic of the running scan"
+        commands, written, sent = self.awg_start
+        return {
+            "points": self.point_index,
+            "final": final,
+            "stages": self.timer.stats(),
+            "visa": self.visa.stats(),
+            "uploads": self.awg_ctl.uploads.stats(),
+            "visa_total": {
+                "commands": self.awg_ctl.commands - commands,
+                "bytes": self.awg_ctl.bytes_written - written,
+                "waveform_bytes": self.awg_ctl.bytes_sent - sent,
+            },
+        }
+
+    def emit_stats(self, final=False):
+        self.stats_time = time.perf_counter()
+        self.timing_stats.emit(self.scan_stats(final))
+
+    def measure(self, program, windows):
+        "Program the AWG, wait until it plays and acquire, timing every stage and counting the VISA traffic"
+        commands, written = self.awg_ctl.commands, self.awg_ctl.bytes_written
+        start = time.perf_counter()
+        with self.timer.stage("program"):
+            program()
+        with self.timer.stage("settle"):
+            self.settle(start)
+        with self.timer.stage("acquire"):
+            data, bins, acq_time = self.acquire(windows)
+        self.visa.add("commands", self.awg_ctl.commands - commands)
+        self.visa.add("bytes", self.awg_ctl.bytes_written - written)
+        return data, bins, acq_time
+
+    def finish(self, result, signal, windows=None, ref_key=None):
+        "Analyse a point now, or on the analysis thread of the pipelined scan"
+        if self.pipeline is not None:
+            self.pipeline.submit(result, signal, windows, ref_key)
+        else:
+            self.analyse(result, signal, windows, ref_key)
+
+    def analyse(self, result, signal, windows=None, ref_key=None):
+        "Counts in the windows of a measured point, reference cache entry and publishing"
+        if windows is not None:
+            with self.timer.stage("counts"):
+                result["counts"] = self.get_counts(result["data"], result["bins"], windows)
+        if ref_key is not None:
+            self.ref_cache.put(ref_key, result)
+        self.publish(result, signal)
+
+    def replay(self, signal):
+        """
+        Publish the next point from the resumed scan file instead of measuring it, None if it was not finished.
+        Called once for every point in scan order.
+        """
+        point = self.next_point
+        self.next_point += 1
+        row = self.completed.get(point)
+        if row is None:
+            return None
+        if self.pipeline is not None:
+            self.pipeline.drain() # publish after the points before it, which are analysed on the pipeline thread
+        result = self.store.result(self.store.rows[row])
+        self.publish(result, signal, store=False)
+        return result
+
+    def ref_key(self, signal_width):
+        samples, control_ch, signal_ch, marker1, t0, tw_pulse_s = AwgCtl.gen_ref_pulses([signal_width])
+        settings = {
+            "acq_mode": self.acq_mode,
+            "acq_time": self.acq_time,
+            "target_uncertainty": self.target_uncertainty,
+            "roi": self.mh_ctl.roi,
+            "roles": self.mh_ctl.roles,
+            "hist_delay": self.hist_delay,
+            "background_window": self.background_window,
+        }
+        return ReferenceCache.key(signal_width, control_ch[0], signal_ch[0], settings)
+
+    def do_reference_measurement(self, signal_width):
+        "Reuse a stored reference of the same signal width and settings if it is younger than the cache ttl"
+        if self.replay(self.finished_ref_scan) is not None:
+            return
+
+        key = self.ref_key(signal_width)
+        result = self.ref_cache.get(key)
+        if result is not None:
+            result["cached"] = True
+            self.finish(result, self.finished_ref_scan)
+            return
+
+        windows = self.ref_windows(signal_width)
+        data, bins, acq_time = self.measure(lambda: self.program_reference(signal_width), windows)
+
+        result = {
+            "signal_width": signal_width,
+            "bins": bins,
+            "data": data,
+            "acq_time": acq_time,
+        }
+        self.finish(result, self.finished_ref_scan, windows, key)
+
+    def do_single_scan(self, write_width, signal_width, offset):
+        "The result has no counts yet in the pipelined scan, they are added on the analysis thread"
+        result = self.replay(self.finished_qm_scan)
+        if result is not None:
+            return result
+
+        windows = self.point_windows(write_width, signal_width, offset)
+        data, bins, acq_time = self.measure(lambda: self.program_point(write_width, signal_width, offset), windows)
+
+        result = {
+            "write_width": write_width,
+            "signal_width": signal_width,
+            "offset": offset,
+            "bins": bins,
+            "data": data,
+            "acq_time": acq_time,
+        }
+        self.finish(result, self.finished_qm_scan, windows)
+        return result
+
+    def do_repeated_scan(self, params):
+        "With params['resume'] the scan in params['store_path'] is continued with its stored parameters"
+        self._stop = False
+        self.store = None
+        self.completed = {}
+        if params.get("resume", False):
+            self.store = ScanStore.resume(params["store_path"])
+            if self.store.roles != self.mh_ctl.roles:
+                self.store.close()
+                raise ValueError(f"Scan was recorded with the channel roles {self.store.roles}, now {self.mh_ctl.roles}")
+            self.completed = {point: row for row, point in enumerate(self.store.points())}
+            params = dict(self.store.header["params"], store_path=params["store_path"])
+        self.point_index = 0
+        self.next_point = 0
+        self.awg_mode = params.get("awg_mode", "upload")
+        self.settle_mode = params.get("settle_mode", "fixed")
+        self.min_dwell = params.get("min_dwell", 0)
+        self.acq_mode = params.get("acq_mode", "histogram")
+        self.acq_time = params.get("acq_time", ScanEngine.acq_time)
+        self.target_uncertainty = params.get("target_uncertainty", self.target_uncertainty)
+        self.ref_cache.ttl = params.get("ref_ttl", self.ref_cache.ttl)
+        self.store_path = params.get("store_path")
+        self.result_buffer = None
+        self.scan_strategy = params.get("scan_strategy", "grid")
+        if self.scan_strategy == "adaptive":
+            # the points are only known during the scan, so they cannot be preloaded or sequenced
+            self.awg_mode = "upload"
+            self.n_points = len(params["signal_width"]) * (1 + params["point_budget"])
+        else:
+            self.n_points = len(params["signal_width"]) * (1 + len(params["write_width"]) * len(params["offset"]))
+        self.scan_params = {name: value for name, value in params.items() if name != "store_path"}
+        self.mh_ctl.set_roi(self.scan_roi(params) if params.get("roi", False) else None)
+        self.timer.clear()
+        self.visa.clear()
+        self.awg_ctl.uploads.clear()
+        self.awg_start = (self.awg_ctl.commands, self.awg_ctl.bytes_written, self.awg_ctl.bytes_sent)
+
+        try:
+            if self.scan_strategy == "adaptive":
+                self.do_adaptive_scan(params)
+            elif self.awg_mode == "pipelined":
+                self.do_pipelined_scan(params)
+            else:
+                self.do_grid_scan(params)
+        finally:
+            if self.store is not None:
+                self.store.close()
+            self.emit_stats(final=True)
+            if self.store_path is not None:
+                write_stats(self.store_path, self.scan_stats(final=True))
+
+    def do_grid_scan(self, params):
+        if self.awg_mode in ["preload", "sequence"]:
+            with self.timer.stage("preload"):
+                self.awg_ctl.preload_scan(params)
+        if self.awg_mode == "sequence":
+            steps = AwgCtl.sequence_table(params)
+            with self.timer.stage("sequence"):
+                self.awg_ctl.build_sequence(steps)
+            # repeated grid values share the step of their first occurrence
+            self.sequence_steps = {}
+            for step, names in enumerate(steps, start=1):
+                self.sequence_steps.setdefault(names, step)
+
+        for signal_width in params["signal_width"]:
+            # perform reference measurement in EIT mode for any new signal width
+            self.do_reference_measurement(signal_width)
+            if self.awg_mode == "upload":
+                self.prepare_pulses(AwgCtl.point_grid(params, signal_width))
+
+            for write_width in params["write_width"]:
+                for offset in params["offset"]:
+                    if self._stop:
+                        return
+                    self.do_single_scan(write_width, signal_width, offset)
+
+    def do_adaptive_scan(self, params):
+        "Coarse grid of write_width x offset first, then refine where the counts change or peak"
+        for signal_width in params["signal_width"]:
+            self.do_reference_measurement(signal_width)
+
+            grid = AdaptiveGrid(params["write_width"], params["offset"], params["point_budget"])
+            points = grid.initial_points()
+            while points:
+                write_width, offset = np.transpose(points)
+                self.prepare_pulses((write_width, np.full(len(points), signal_width), offset))
+                for write_width, offset in points:
+                    if self._stop:
+                        return
+                    result = self.do_single_scan(write_width, signal_width, offset)
+                    grid.add(write_width, offset, result["counts"])
+                points = grid.next_points()
+
+    def do_pipelined_scan(self, params):
+        """
+        Same points as do_repeated_scan, but the next waveforms are uploaded and the previous point
+        is analysed, stored and published during the acquisition
+        """
+        pipeline = ScanPipeline(self.awg_ctl, params, self.analyse)
+        self.pipeline = pipeline
+        pipeline.start()
+        try:
+            for point in pipeline:
+                if self._stop:
+                    break
+                if point[0] == "ref":
+                    self.do_reference_measurement(point[1])
+                else:
+                    self.do_single_scan(*point[1:])
+        finally:
+            self.pipeline = None
+            pipeline.stop()
+        if pipeline.analysis_error is not None:
+            raise pipeline.analysis_error
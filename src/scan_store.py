@@ -0,0 +1,116 @@
+"""
+One appendable binary file per scan.
+
+Layout: magic, JSON header (columns, histogram length, data shape, channel
+roles, scan parameters), the bins axis once, then fixed size rows of the
+parameter columns followed by the uint32 histograms (one per role). Rows are appended as points finish and the file is opened
+as a memory map, so loading does not read the histograms.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+magic = b"QMSCAN1\0"
+columns = ["reference", "write_width", "signal_width", "offset", "acq_time", "counts", "point"]
+
+
+class ScanStore:
+    def __init__(self, path, header, data_offset):
+        self.path = Path(path)
+        self.header = header
+        self.nbins = header["nbins"]
+        self.shape = tuple(header.get("shape", [self.nbins])) # files before multi-channel acquisition hold one histogram
+        self.roles = header.get("roles", {"signal": 1})
+        self.row_dtype = np.dtype([(name, "<f8") for name in header["columns"]] + [("data", "<u4", self.shape)])
+        self.data_offset = data_offset
+        self.bins = np.memmap(self.path, dtype="<f8", mode="r", offset=data_offset - 8*self.nbins, shape=(self.nbins,))
+        self.file = None
+
+    def create(path, bins, params=None, shape=None, roles=None):
+        "New scan file with the bins axis written once, open for appending. shape is that of the data of one point"
+        bins = np.ascontiguousarray(bins, dtype="<f8")
+        header = {
+            "columns": columns,
+            "nbins": len(bins),
+            "shape": list(shape or (len(bins),)),
+            "roles": roles or {"signal": 1},
+            "params": {name: np.asarray(value).tolist() for name, value in (params or {}).items()},
+        }
+        header_bytes = json.dumps(header).encode()
+        # pad so bins and rows start 8 byte aligned
+        header_bytes += b" " * (-(len(magic) + 8 + len(header_bytes)) % 8)
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(magic)
+            f.write(np.uint64(len(header_bytes)).tobytes())
+            f.write(header_bytes)
+            f.write(bins.tobytes())
+            data_offset = f.tell()
+
+        store = ScanStore(path, header, data_offset)
+        store.file = open(path, "ab")
+        return store
+
+    def open(path):
+        "Open an existing scan file for reading"
+        with open(path, "rb") as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(f"{path} is not a scan file")
+            header_len = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            header = json.loads(f.read(header_len))
+        data_offset = len(magic) + 8 + header_len + 8*header["nbins"]
+        return ScanStore(path, header, data_offset)
+
+    def resume(path):
+        "Open an existing scan file for appending, a partly written last row is cut off"
+        store = ScanStore.open(path)
+        with open(path, "r+b") as f:
+            f.truncate(store.data_offset + len(store.rows) * store.row_dtype.itemsize)
+        store.file = open(path, "ab")
+        return store
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, result):
+        "Append one finished point (a scan result dict), reference measurements have no write_width"
+        row = np.zeros((), dtype=self.row_dtype)
+        row["reference"] = "write_width" not in result
+        for name in self.header["columns"][1:]:
+            row[name] = result.get(name, np.nan)
+        row["data"] = result["data"]
+        self.file.write(row.tobytes())
+        self.file.flush()
+
+    @property
+    def rows(self):
+        "Memory mapped rows, columns are accessed by name (rows['offset'], rows['data'])"
+        n = (self.path.stat().st_size - self.data_offset) // self.row_dtype.itemsize # ignore a partly written row
+        if n == 0:
+            return np.zeros(0, dtype=self.row_dtype)
+        return np.memmap(self.path, dtype=self.row_dtype, mode="r", offset=self.data_offset, shape=(n,))
+
+    def points(self):
+        "Point index in scan order of every row, files without the point column were written in scan order"
+        rows = self.rows
+        if "point" in self.header["columns"]:
+            return rows["point"].astype(np.int64)
+        return np.arange(len(rows))
+
+    def result(self, row):
+        "One row as the result dict emitted by ScanEngine, data is a view into the file"
+        result = {name: float(row[name]) for name in self.header["columns"][1:]}
+        if row["reference"]:
+            del result["write_width"], result["offset"]
+        result["bins"] = self.bins
+        result["data"] = row["data"]
+        return result
+
+    def results(self):
+        "Rows as the result dicts emitted by ScanEngine, data are views into the file"
+        return [self.result(row) for row in self.rows]
@@ -0,0 +1,345 @@
+"""
+Simulated AWG5204 and MultiHarp for running the scan without the instruments.
+
+SimulatedAwg stands in for the pyvisa resource of AwgCtl and understands the SCPI
+subset AwgCtl sends. SimulatedMultiHarp stands in for snAPI and histograms the
+signal waveform the simulated AWG is currently playing, with Poisson noise and
+dark counts. Command latency, upload bandwidth, settling and integration times
+are real sleeps, multiplied by time_scale to run faster than the hardware.
+"""
+
+import enum
+import re
+import tempfile
+import time
+import types
+from pathlib import Path
+
+import numpy as np
+
+from awg_ctl import AwgCtl
+from mh_ctl import MhCtl
+
+
+class SimulatedAwg:
+    "pyvisa resource of an AWG5204 with two waveform channels, a waveform list and a sequencer"
+
+    def __init__(self, time_scale=1.0, latency=1E-3, bandwidth=40E6, settle_time=0.05):
+        self.time_scale = time_scale
+        self.latency = latency # (in s) per command
+        self.bandwidth = bandwidth # (in bytes/s) of binary blocks
+        self.settle_time = settle_time # (in s) until new waveforms play after a change
+        self.timeout = 10000
+
+        self.wlist = {} # name -> {"data": float32 samples, "marker": uint8 samples}
+        self.channel_wfm = {1: None, 2: None}
+        self.sequence = {} # step -> (track 1, track 2) waveform names
+        self.sequence_step = None # current step while a sequence is assigned
+        self.outputs = {n: False for n in range(1, 5)}
+        self.running = False
+        self.changed = 0.0 # perf_counter of the last change of the played waveforms
+
+        self.commands = 0
+        self.bytes_received = 0
+
+    def wait(self, seconds):
+        if seconds > 0 and self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def played(self, channel):
+        "Name of the waveform currently played on a channel"
+        if self.sequence_step is not None:
+            return self.sequence[self.sequence_step][channel - 1]
+        return self.channel_wfm[channel]
+
+    def waveform(self, channel):
+        "Samples played on a channel, None while stopped or nothing is assigned"
+        name = self.played(channel) if self.running and self.outputs[channel] else None
+        return None if name is None else self.wlist[name]["data"]
+
+    def touch(self):
+        self.changed = time.perf_counter()
+
+    def write(self, command):
+        self.commands += 1
+        self.wait(self.latency)
+        command = command.strip()
+        low = command.lower()
+        names = re.findall(r'"([^"]*)"', command)
+        numbers = [int(n) for n in re.findall(r"(?<![\w.])(\d+)(?![\w.])", command.split('"')[-1])]
+
+        if low.startswith("wlist:waveform:delete"):
+            if low.endswith("all"):
+                self.wlist.clear()
+            else:
+                self.wlist.pop(names[0], None)
+            self.channel_wfm = {ch: wfm for ch, wfm in self.channel_wfm.items() if wfm in self.wlist}
+        elif low.startswith("wlist:waveform:new"):
+            self.wlist[names[0]] = {"data": np.zeros(numbers[-1], dtype=np.float32), "marker": np.zeros(numbers[-1], dtype=np.uint8)}
+        elif re.match(r"source\d:waveform", low):
+            self.channel_wfm[int(low[6])] = names[0]
+            self.sequence_step = None
+            self.touch()
+        elif re.match(r"output\d ", low):
+            self.outputs[int(low[6])] = low.endswith("on")
+        elif low.startswith("awgcontrol:run"):
+            self.running = True
+            self.touch()
+        elif low.startswith("awgcontrol:stop"):
+            self.running = False
+        elif low.startswith("slist:sequence:delete"):
+            self.sequence = {}
+            self.sequence_step = None
+        elif low.startswith("slist:sequence:new"):
+            self.sequence = {step: (None, None) for step in range(1, numbers[-2] + 1)}
+        elif re.match(r"slist:sequence:step\d+:tasset\d:waveform", low):
+            step, track = [int(n) for n in re.findall(r"\d+", low.split()[0])]
+            tracks = list(self.sequence[step])
+            tracks[track - 1] = names[1]
+            self.sequence[step] = tuple(tracks)
+        elif re.match(r"source\d:casset:sequence", low):
+            self.sequence_step = 1
+            self.touch()
+        elif low.startswith("trigger:immediate"):
+            if self.sequence_step is not None:
+                self.sequence_step = self.sequence_step % len(self.sequence) + 1
+                self.touch()
+        elif re.match(r"source\d:jump:force", low):
+            if self.sequence_step is not None and self.sequence_step != numbers[-1]:
+                self.sequence_step = numbers[-1]
+                self.touch()
+
+    def write_raw(self, message):
+        "Definite length block: command \"name\", first, size, #<digits><length><block>"
+        self.commands += 1
+        start = message.index(b"#")
+        digits = int(message[start + 1:start + 2])
+        length = int(message[start + 2:start + 2 + digits])
+        block = message[start + 2 + digits:start + 2 + digits + length]
+        self.bytes_received += len(message)
+        self.wait(self.latency + len(message) / self.bandwidth)
+
+        header = message[:start].decode()
+        name = re.search(r'"([^"]*)"', header).group(1)
+        first = int(header.split(",")[1])
+        if header.lower().startswith("wlist:waveform:marker:data"):
+            values, key = np.frombuffer(block, dtype="<u1"), "marker"
+        else:
+            values, key = np.frombuffer(block, dtype="<f4"), "data"
+        self.wlist[name][key][first:first + len(values)] = values
+
+    def query(self, command):
+        self.commands += 1
+        self.wait(2*self.latency)
+        low = command.strip().lower()
+        if low == "*idn?":
+            return "TEKTRONIX,AWG5204,SIMULATED,0"
+        if low == "*opc?":
+            return "1"
+        if low == "wlist:list?":
+            return ",".join(f'"{name}"' for name in self.wlist)
+        if low == "system:error:all?":
+            return '0,"No error"'
+        if low == "awgcontrol:rstate?":
+            if not self.running:
+                return "0"
+            return "2" if (time.perf_counter() - self.changed) >= self.settle_time * self.time_scale else "1"
+        raise ValueError(f"Simulated AWG does not understand {command!r}")
+
+    def close(self):
+        pass
+
+
+class MeasMode(enum.IntEnum):
+    Histogram = 0
+    T2 = 2
+    T3 = 3
+
+
+class SimulatedHistogram:
+    "snAPI histogram measurement"
+
+    def __init__(self, device):
+        self.device = device
+        self.data = None
+
+    def measure(self, acqTime=1000, waitFinished=True, savePTU=False):
+        expected = self.device.expected(acqTime)
+        self.data = self.device.rng.poisson(expected).astype(np.uint32)
+        self.device.wait(acqTime / 1E3)
+
+    def getData(self):
+        return self.data, self.device.bins
+
+
+class SimulatedUnfold:
+    "snAPI T2 time tag measurement, getData returns the events since the previous call"
+
+    def __init__(self, device):
+        self.device = device
+        self.acq_time = 0
+        self.start = None
+        self.fetched = 0 # (in ms) simulated time already returned
+        self.stopped = True
+
+    def elapsed(self):
+        "Simulated measurement time so far (in ms)"
+        real = (time.perf_counter() - self.start) * 1E3
+        return min(real / self.device.time_scale if self.device.time_scale > 0 else self.acq_time, self.acq_time)
+
+    def measure(self, acqTime=1000, waitFinished=False, savePTU=False):
+        self.acq_time = acqTime
+        self.start = time.perf_counter()
+        self.fetched = 0
+        self.stopped = False
+        if waitFinished:
+            self.device.wait(acqTime / 1E3)
+
+    def isFinished(self):
+        return self.stopped or self.elapsed() >= self.acq_time
+
+    def stopMeasure(self):
+        self.stopped = True
+
+    def getData(self):
+        until = self.fetched if self.stopped else self.elapsed()
+        times, channels = self.device.events(self.fetched, until)
+        self.fetched = until
+        return times, channels
+
+
+class SimulatedMultiHarp:
+    """
+    snAPI object of a MultiHarp whose detector channel 1 sees the signal waveform of the
+    simulated AWG, every other channel only dark counts.
+    detection is the mean number of detections per sync of a full intensity sample,
+    resolution is the bin width of MH.ini (Binning = 1 doubles the 5 ps base resolution).
+    """
+
+    def __init__(self, awg, time_scale=1.0, resolution=10, nbins=65536, channels=4, detection=1E-3, dark_rate=100,
+                 efficiency=0.3, storage_delay=250, connect_time=0.5, seed=None):
+        self.awg = awg
+        self.time_scale = time_scale
+        self.resolution = resolution # (in ps)
+        self.bins = np.arange(nbins) * float(resolution)
+        self.channels = channels
+        self.detection = detection
+        self.dark_rate = dark_rate # (in Hz) per channel
+        self.efficiency = efficiency # stored fraction at full overlap of signal and control
+        self.storage_delay = storage_delay # (in samples) between write and read control pulse
+        self.connect_time = connect_time # (in s)
+        self.rng = np.random.default_rng(seed)
+        self.deviceConfig = {"Resolution": resolution}
+        self.histogram = SimulatedHistogram(self)
+        self.unfold = SimulatedUnfold(self)
+        self.profile_cache = (None, None) # ids of the played waveforms, profile
+        self.pattern = (None, dark_rate, dark_rate) # change time of the played pattern, its channel 1 rate, the previous one
+
+    def wait(self, seconds):
+        if seconds > 0 and self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def getDevice(self):
+        self.wait(self.connect_time)
+
+    def initDevice(self, mode):
+        self.wait(0.1)
+
+    def loadIniConfig(self, path):
+        pass
+
+    def closeDevice(self):
+        pass
+
+    def sync_rate(self):
+        "Marker 1 of the played waveforms is the sync"
+        return AwgCtl.repetition_rate if self.awg.waveform(1) is not None else 0.0
+
+    def getCountRates(self):
+        """
+        Sync and channel rates of the last finished 100 ms counter gate. A gate that started before the
+        played pattern changed still shows the rate of the previous pattern.
+        """
+        now = time.perf_counter()
+        rate = self.sync_rate() * self.profile().sum() + self.dark_rate
+        if self.awg.changed != self.pattern[0]:
+            self.pattern = (self.awg.changed, rate, self.pattern[1])
+        gate = MhCtl.rate_gate * self.time_scale
+        if gate > 0 and (now // gate - 1) * gate < self.awg.changed + self.awg.settle_time * self.time_scale:
+            rate = self.pattern[2] # stale
+        counted = self.rng.poisson(rate * MhCtl.rate_gate) / MhCtl.rate_gate
+        rates = [counted] + [self.dark_rate] * (self.channels - 1)
+        return self.sync_rate(), rates
+
+    def profile(self):
+        """
+        Mean detections per sync in every bin of channel 1 from the played waveforms.
+        The EOMs turn the -1..1 waveforms into 0..1 intensities. The overlap of signal and
+        control decides the stored fraction, which is retrieved by the first control pulse
+        more than half the storage delay after the signal.
+        """
+        signal, control = self.awg.waveform(2), self.awg.waveform(1)
+        if signal is None:
+            return np.zeros(len(self.bins))
+        if self.profile_cache[0] == (id(signal), id(control)):
+            return self.profile_cache[1]
+        intensity = (np.clip(signal, -1, 1) + 1) / 2
+        if control is not None:
+            control = (np.clip(control, -1, 1) + 1) / 2
+            area = max(intensity.sum(), 1E-12)
+            stored = self.efficiency * np.dot(intensity, control) / area
+            read = np.where(np.arange(len(control)) > np.argmax(intensity) + self.storage_delay // 2, control, 0)
+            intensity = (1 - stored) * intensity + stored * area * read / max(read.sum(), 1E-12)
+        times = (np.arange(len(intensity)) - AwgCtl.marker_start) * AwgCtl.sample_period # (in ps) after the sync
+        profile = np.interp(self.bins, times, intensity * self.detection, left=0, right=0) * self.resolution / AwgCtl.sample_period
+        self.profile_cache = ((id(signal), id(control)), profile)
+        return profile
+
+    def expected(self, acq_time):
+        "Mean histogram of all channels for acq_time (in ms), row 0 is the sync channel"
+        syncs = self.sync_rate() * acq_time / 1E3
+        dark = self.dark_rate * acq_time / 1E3 / len(self.bins)
+        expected = np.full((self.channels + 1, len(self.bins)), dark)
+        expected[0] = 0
+        expected[1] += syncs * self.profile()
+        return expected
+
+    def events(self, start, stop):
+        "Time tags (in ps) of the syncs and channel 1 between start and stop (in ms) of the measurement"
+        rate = self.sync_rate()
+        if stop <= start or rate == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        period = int(round(1E12 / rate))
+        first = int(np.ceil(start * 1E9 / period))
+        sync = np.arange(first, int(np.ceil(stop * 1E9 / period)), dtype=np.int64) * period
+
+        profile = self.profile()
+        total = profile.sum()
+        n = self.rng.poisson(total * len(sync)) if len(sync) else 0
+        at = sync[self.rng.integers(0, len(sync), n)] if n else np.zeros(0, dtype=np.int64)
+        offsets = self.rng.choice(len(profile), n, p=profile / total) * self.resolution if n else np.zeros(0, dtype=np.int64)
+        dark = self.rng.integers(int(start * 1E9), int(stop * 1E9), self.rng.poisson(self.dark_rate * (stop - start) / 1E3))
+
+        times = np.concatenate([sync, at + offsets.astype(np.int64), dark])
+        channels = np.concatenate([np.zeros(len(sync), dtype=np.int64), np.ones(n + len(dark), dtype=np.int64)])
+        order = np.argsort(times, kind="stable")
+        return times[order], channels[order]
+
+
+def snapi_module(awg, **options):
+    "Stand-in for the snAPI.Main module, whose snAPI() is a MultiHarp simulated from awg"
+    return types.SimpleNamespace(MeasMode=MeasMode, snAPI=lambda: SimulatedMultiHarp(awg, **options))
+
+
+def factories(time_scale=1.0, wlist_log=None, **options):
+    """
+    DeviceManager factories of a simulated AWG and MultiHarp sharing one setup.
+    The waveform list log defaults to a temporary file, so the log of the real AWG is not touched.
+    """
+    if wlist_log is None:
+        wlist_log = Path(tempfile.mkdtemp()) / "awg_wlist.log"
+    awg = SimulatedAwg(time_scale)
+    return {
+        "AWG": lambda: AwgCtl(awg, wlist_log),
+        "MultiHarp": lambda: MhCtl(snapi_module(awg, time_scale=time_scale, **options)),
+    }
@@ -0,0 +1,161 @@
+"""
+Incremental histogramming of MultiHarp time tags.
+
+Event sources yield chunks of (times, channels) with times in ps and channel 0
+being the sync, the same layout snAPI's unfold measurement returns. Besides the
+live device (MhCtl.get_data_streaming) a recorded T2 PTU file or a synthetic
+generator can be used, so the histogramming can be run without the MultiHarp.
+"""
+
+import numpy as np
+
+
+class StreamHistogram:
+    """
+    Start-stop histogram of detector channels against the preceding sync, filled chunk by chunk.
+    channel is one channel (data has nbins) or a list of channels (data is len(channel) x nbins).
+    """
+
+    def __init__(self, resolution, nbins=65536, channel=1):
+        self.resolution = resolution # (in ps) bin width
+        self.channel = channel
+        self.channels = list(np.atleast_1d(channel))
+        self.data = np.zeros((len(self.channels), nbins) if np.ndim(channel) else nbins, dtype=np.uint32)
+        self.rows = np.atleast_2d(self.data) # view with one row per channel
+        self.bins = np.arange(nbins) * resolution
+        self.last_sync = None # last sync of the previous chunk, for events at the start of the next one
+        self.events = 0
+
+    def window_counts(self, start, stop):
+        "Counts of the first channel between start and stop (in ps)"
+        i0, i1 = np.searchsorted(self.bins, [start, stop])
+        return int(self.rows[0, i0:i1].sum())
+
+    def add(self, times, channels):
+        sync = times[channels == 0]
+        for row, channel in enumerate(self.channels):
+            self.add_channel(self.rows[row], sync, times[channels == channel])
+        if len(sync):
+            self.last_sync = sync[-1]
+
+    def add_channel(self, data, sync, det):
+        if len(det):
+            idx = np.searchsorted(sync, det, side="right") - 1
+            start = sync[np.maximum(idx, 0)] if len(sync) else np.zeros_like(det)
+            before = idx < 0
+            if self.last_sync is None:
+                # events before the very first sync have no reference
+                det = det[~before]
+                start = start[~before]
+            else:
+                start[before] = self.last_sync
+
+            b = ((det - start) / self.resolution).astype(np.int64)
+            b = b[b < len(data)]
+            np.add(data, np.bincount(b, minlength=len(data)), out=data, casting="unsafe")
+            self.events += len(b)
+
+
+def histogram_events(chunks, hist, on_partial=None):
+    "Feed every chunk of an event source into hist, on_partial(data, bins) is called after each chunk"
+    for times, channels in chunks:
+        hist.add(times, channels)
+        if on_partial is not None:
+            on_partial(hist.data, hist.bins)
+    return hist.data, hist.bins
+
+
+# PTU tag types with a length field followed by the data
+_ptu_var_types = [0x2001FFFF, 0x4001FFFF, 0x4002FFFF, 0xFFFFFFFF]
+# T2 record types using the HydraHarp v2 layout: HydraHarp2, TimeHarp260N/P, MultiHarp
+_ptu_t2_types = [0x01010204, 0x00010205, 0x00010206, 0x00010207]
+_t2_wraparound = 33554432
+
+
+def read_ptu_header(f):
+    "Read the tag header of a PTU file, returns a dict of tag name to value and leaves f at the first record"
+    if f.read(8).rstrip(b"\0") != b"PQTTTR":
+        raise ValueError("Not a PTU file")
+    f.read(8) # version
+
+    tags = {}
+    while True:
+        ident = f.read(32).rstrip(b"\0").decode()
+        idx = int.from_bytes(f.read(4), "little", signed=True)
+        typ = int.from_bytes(f.read(4), "little")
+        value = f.read(8)
+        if idx > -1:
+            ident = f"{ident}({idx})"
+
+        if typ in _ptu_var_types:
+            value = f.read(int.from_bytes(value, "little"))
+        elif typ == 0x20000008:
+            value = np.frombuffer(value, dtype="<f8")[0]
+        else:
+            value = int.from_bytes(value, "little", signed=True)
+        tags[ident] = value
+
+        if ident == "Header_End":
+            return tags
+
+
+def read_ptu_t2(path, chunk_records=1_000_000):
+    "Event source from a recorded T2 PTU file, yields (times in ps, channels) per chunk of records"
+    with open(path, "rb") as f:
+        tags = read_ptu_header(f)
+        if tags["TTResultFormat_TTTRRecType"] not in _ptu_t2_types:
+            raise ValueError("Only HydraHarp2/TimeHarp260/MultiHarp T2 files are supported")
+        resolution = int(np.rint(tags["MeasDesc_GlobalResolution"] * 1E12)) # (in ps)
+        remaining = tags["TTResult_NumberOfRecords"]
+
+        overflow = 0
+        while remaining > 0:
+            records = np.fromfile(f, dtype="<u4", count=min(chunk_records, remaining))
+            if len(records) == 0:
+                return
+            remaining -= len(records)
+
+            special = (records >> 31).astype(bool)
+            channel = ((records >> 25) & 0x3F).astype(np.int64)
+            timetag = (records & 0x1FFFFFF).astype(np.int64)
+
+            "Overflow records carry the number of wraparounds since the last one"
+            is_overflow = special & (channel == 0x3F)
+            wraps = np.where(is_overflow, np.maximum(timetag, 1), 0)
+            offset = overflow + np.cumsum(wraps) * _t2_wraparound
+            overflow = offset[-1]
+
+            "Sync is special channel 0, detectors are the regular records (channel 0 is detector 1)"
+            is_sync = special & (channel == 0)
+            keep = is_sync | ~special
+            times = (offset[keep] + timetag[keep]) * resolution
+            channels = np.where(is_sync[keep], 0, channel[keep] + 1)
+            yield times, channels
+
+
+def synthetic_events(acq_time, pulses, sync_period=2_000_000, background=0.0, chunk_time=100, channel=1, seed=None):
+    """
+    Event source without hardware: acq_time and chunk_time in ms, sync_period in ps.
+    pulses is a list of (center, width, mean counts per sync) with center and FWHM width in ps,
+    background is the mean number of uncorrelated counts per sync.
+    """
+    rng = np.random.default_rng(seed)
+    syncs_per_chunk = int(chunk_time * 1E9 / sync_period)
+    start = 0
+    for _ in range(int(np.ceil(acq_time / chunk_time))):
+        sync = start + np.arange(syncs_per_chunk, dtype=np.int64) * sync_period
+
+        events = [sync]
+        for center, width, rate in pulses:
+            n = rng.poisson(rate * syncs_per_chunk)
+            at = sync[rng.integers(0, syncs_per_chunk, n)]
+            events.append(at + np.rint(rng.normal(center, width / (2*np.sqrt(2*np.log(2))), n)).astype(np.int64))
+        n = rng.poisson(background * syncs_per_chunk)
+        events.append(start + rng.integers(0, syncs_per_chunk * sync_period, n))
+
+        times = np.concatenate(events)
+        channels = np.full(len(times), channel)
+        channels[:len(sync)] = 0
+        order = np.argsort(times, kind="stable")
+        yield times[order], channels[order]
+        start += syncs_per_chunk * sync_period
@@ -0,0 +1,64 @@
+"""
+Per-stage statistics of a scan.
+
+A StageTimer collects one sample per point and stage, either durations of
+`with timer.stage(name):` blocks (in s) or counts added directly (VISA commands,
+bytes). stats() summarises every stage as count, mean, p95 and total.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {} # stage -> list of values, in the order the stages first ran
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, value):
+        self.samples.setdefault(name, []).append(value)
+
+    def clear(self):
+        self.samples.clear()
+
+    def stats(self):
+        stats = {}
+        for name, values in list(self.samples.items()): # stages may be added by the analysis thread meanwhile
+            values = np.asarray(values, dtype=np.float64)
+            stats[name] = {"count": len(values), "mean": values.mean(), "p95": np.percentile(values, 95), "total": values.sum()}
+        return stats
+
+
+def format_stats(stats, unit=1E3, unit_name="ms"):
+    "Fixed width table of the stats of one timer, values multiplied by unit"
+    lines = [f"{'':<10}{'n':>6}{'mean':>9}{'p95':>9}{'total':>10}  ({unit_name})"]
+    for name, s in stats.items():
+        lines.append(f"{name:<10}{s['count']:>6}{s['mean']*unit:>9.2f}{s['p95']*unit:>9.2f}{s['total']*unit:>10.0f}")
+    return "\n".join(lines)
+
+
+def upload_rate(stats):
+    "Number and throughput of the waveform uploads, from the stats of AwgCtl.uploads"
+    if "kB" not in stats:
+        return "Uploads: none"
+    kilobytes, seconds = stats["kB"]["total"], stats["seconds"]["total"]
+    return f"Uploads: {stats['kB']['count']}, {kilobytes / 1E3:.1f} MB at {kilobytes / 1E3 / max(seconds, 1E-9):.1f} MB/s"
+
+
+def write_stats(path, stats):
+    "Store the statistics as json next to the scan file (scan.qms -> scan.timing.json)"
+    path = Path(path).with_suffix(".timing.json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(stats, indent=1, default=float))
+    return path
@@ -0,0 +1,45 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import simulated
+from scan_engine import ScanEngine
+
+root = Path(__file__).parent.parent
+
+
+@pytest.fixture
+def scan_dir(tmp_path, monkeypatch):
+    "Scratch working directory with the MultiHarp settings, like benchmark.py"
+    for name in ["MH.ini", "MH_channels.ini"]:
+        shutil.copyfile(root / name, tmp_path / name)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def connect(scan_dir):
+    "ScanEngine on fresh simulated instruments, all instrument times scaled by time_scale"
+    def connect(time_scale=0.001, seed=0):
+        engine = ScanEngine(simulated.factories(time_scale, seed=seed), "references")
+        engine.connect_devices()
+        return engine
+    return connect
+
+
+def scan_params(awg_mode="upload", store_path="scan.qms", **params):
+    "A small grid with two signal widths, references are never taken from the cache"
+    return {
+        "write_width": np.linspace(5, 40, 3),
+        "offset": np.linspace(-10, 10, 3),
+        "signal_width": np.array([5.0, 10.0]),
+        "awg_mode": awg_mode,
+        "settle_mode": "awg",
+        "acq_mode": "histogram",
+        "acq_time": 1000,
+        "ref_ttl": 0,
+        "store_path": store_path,
+        **params,
+    }
@@ -0,0 +1,17 @@
+import numpy as np
+
+from adaptive_scan import AdaptiveGrid
+
+
+def test_refinement_stops_at_the_target_resolution():
+    write_width, offset = np.linspace(0.1, 0.7, 4), np.linspace(-3, 3.3, 7)
+    grid = AdaptiveGrid(write_width, offset, budget=10000)
+    points = grid.initial_points()
+    while points:
+        for w, o in points:
+            grid.add(w, o, np.exp(-((w - 0.4)**2 + (o - 1)**2)))
+        points = grid.next_points()
+
+    steps = np.array(grid.resolution)
+    fine = (np.array(list(grid.counts)) - [write_width[0], offset[0]]) / steps
+    np.testing.assert_allclose(fine, np.round(fine), atol=1E-6)
@@ -0,0 +1,109 @@
+import time
+
+import numpy as np
+import pytest
+
+from conftest import scan_params
+from scan_engine import ScanEngine
+from scan_store import ScanStore
+
+
+def stored_rows(path):
+    store = ScanStore.open(path)
+    return store.rows.copy()
+
+
+def assert_rows_equal(rows, expected):
+    assert len(rows) == len(expected)
+    for name in rows.dtype.names:
+        np.testing.assert_array_equal(rows[name], expected[name], err_msg=name)
+
+
+def test_awg_modes_store_the_same_rows(connect):
+    "Every AWG mode plays the same waveforms, so the same seed gives the same scan file"
+    expected = None
+    for awg_mode in ["upload", "preload", "sequence", "pipelined"]:
+        engine = connect()
+        engine.do_repeated_scan(scan_params(awg_mode, f"{awg_mode}.qms"))
+        rows = stored_rows(f"{awg_mode}.qms")
+        assert len(rows) == engine.n_points == 20
+        if expected is None:
+            expected = rows
+        else:
+            assert_rows_equal(rows, expected)
+
+
+@pytest.mark.parametrize("awg_mode", ["upload", "pipelined"])
+def test_stop_and_resume_gives_contiguous_points(connect, awg_mode):
+    engine = connect()
+
+    def stop(result):
+        if result["point"] == 7:
+            engine._stop = True
+    engine.finished_qm_scan.connect(stop)
+    engine.do_repeated_scan(scan_params(awg_mode))
+    engine.finished_qm_scan.disconnect(stop)
+    stopped = len(stored_rows("scan.qms"))
+    assert 8 <= stopped < engine.n_points
+
+    engine.do_repeated_scan({"resume": True, "store_path": "scan.qms"})
+    store = ScanStore.open("scan.qms")
+    np.testing.assert_array_equal(store.points(), np.arange(engine.n_points))
+    assert engine.point_index == engine.n_points
+
+
+def test_resume_cuts_a_partly_written_row(connect):
+    engine = connect()
+    engine.do_repeated_scan(scan_params())
+    expected = stored_rows("scan.qms")
+    with open("scan.qms", "r+b") as f:
+        f.truncate(f.seek(0, 2) - expected.dtype.itemsize - 100)
+
+    engine = connect()
+    engine.do_repeated_scan({"resume": True, "store_path": "scan.qms"})
+    rows = stored_rows("scan.qms")
+    # the last two points are measured again, with new Poisson noise
+    assert_rows_equal(rows[:-2], expected[:-2])
+    np.testing.assert_array_equal(rows["point"], expected["point"])
+
+
+@pytest.mark.parametrize("signal_width", [[5.0], [5.0, 20.0]])
+def test_roi_covers_every_point_window(scan_dir, signal_width):
+    engine = ScanEngine(ref_cache_path="references")
+    params = scan_params(offset=np.linspace(-10, 10, 21), signal_width=np.array(signal_width))
+    roi = engine.scan_roi(params)
+    for s in params["signal_width"]:
+        windows = engine.ref_windows(s)
+        for w in params["write_width"]:
+            for o in params["offset"]:
+                windows += engine.point_windows(w, s, o)
+        for start, stop in windows:
+            assert any(r0 <= start and stop <= r1 for r0, r1 in roi), (s, start, stop)
+
+
+def overlaps(intervals, others):
+    return sum(1 for a in intervals if any(a[0] < b[1] and b[0] < a[1] for b in others))
+
+
+def test_pipelined_analysis_overlaps_acquisition(connect):
+    engine = connect(time_scale=0.05)
+    acquisitions, analyses = [], []
+    acquire, analyse = engine.acquire, engine.analyse
+
+    def timed_acquire(windows):
+        start = time.perf_counter()
+        result = acquire(windows)
+        acquisitions.append((start, time.perf_counter()))
+        return result
+
+    def slow_analyse(*job):
+        start = time.perf_counter()
+        time.sleep(0.05)
+        analyse(*job)
+        analyses.append((start, time.perf_counter()))
+
+    engine.acquire, engine.analyse = timed_acquire, slow_analyse
+    engine.do_repeated_scan(scan_params("pipelined", signal_width=np.array([10.0])))
+    assert len(analyses) == len(acquisitions) == 10
+    # every analysis but the last runs during the next acquisition
+    assert overlaps(analyses, acquisitions) >= len(analyses) - 2
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from stream import StreamHistogram
+
+
+def brute_force(times, channels, channel, resolution, nbins):
+    "Histogram of every event of channel against the last sync at or before it"
+    sync = times[channels == 0]
+    data = np.zeros(nbins, dtype=np.uint32)
+    for t in times[channels == channel]:
+        before = sync[sync <= t]
+        if len(before):
+            b = int((t - before[-1]) // resolution)
+            if b < nbins:
+                data[b] += 1
+    return data
+
+
+@pytest.mark.parametrize("channel", [1, [1, 3]])
+def test_stream_histogram_matches_brute_force(channel):
+    rng = np.random.default_rng(1)
+    resolution, nbins = 10, 400
+    sync = np.arange(50) * 3000 + 500
+    det = rng.integers(0, sync[-1] + 3000, 2000)
+    times = np.concatenate([sync, det])
+    channels = np.concatenate([np.zeros(len(sync), dtype=np.int64), rng.integers(1, 4, len(det))])
+    order = np.argsort(times, kind="stable")
+    times, channels = times[order], channels[order]
+
+    hist = StreamHistogram(resolution, nbins, channel)
+    # chunks that split the events between syncs
+    for chunk in np.array_split(np.arange(len(times)), 7):
+        hist.add(times[chunk], channels[chunk])
+
+    expected = np.stack([brute_force(times, channels, c, resolution, nbins) for c in np.atleast_1d(channel)])
+    np.testing.assert_array_equal(np.atleast_2d(hist.data), expected)
+    assert hist.data.shape == ((len(channel), nbins) if np.ndim(channel) else (nbins,))